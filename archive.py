@@ -0,0 +1,488 @@
+import os
+import io
+import json
+import zlib
+import struct
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+import hashing
+
+# tarfile, zipfile and concurrent.futures are imported where they are used, since most
+# commands don't read or write archives and importing them slows down every start
+# pylint: disable=import-outside-toplevel
+
+ZIP_ARCHIVE = 'backup.zip'
+TAR_ZSTD_ARCHIVE = 'backup.tar.zst'
+ARCHIVE_NAMES = [ZIP_ARCHIVE, TAR_ZSTD_ARCHIVE]
+# Member describing the backup, written first. Archives without it are full backups
+MANIFEST_NAME = '.backup_manifest.json'
+# Member with the digest of every file, written last since they are hashed as they are archived.
+# It's read into the manifest as 'digests', see extract_members
+DIGESTS_NAME = '.backup_digests.json'
+METADATA_NAMES = { MANIFEST_NAME, DIGESTS_NAME }
+
+# Compression method -> (archive it's stored in, valid levels)
+COMPRESSION_METHODS = {
+    'store': (ZIP_ARCHIVE, None),
+    'deflate': (ZIP_ARCHIVE, range(1, 10)),
+    'lzma': (ZIP_ARCHIVE, None),
+    'zstd': (TAR_ZSTD_ARCHIVE, range(1, 23))
+}
+DEFAULT_COMPRESSION = 'deflate'
+
+# Compression method -> zipfile constant
+_ZIP_COMPRESS_TYPES = {
+    'store': 'ZIP_STORED',
+    'deflate': 'ZIP_DEFLATED',
+    'lzma': 'ZIP_LZMA'
+}
+
+_DD_SIGNATURE = 0x08074b50 # Signature of the zip data descriptor
+
+# Formats that are already compressed, so they are stored as they are
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.7z', '.aac', '.avi', '.bz2', '.flac', '.gif', '.gz', '.heic', '.jpeg', '.jpg', '.lz4', '.lzma',
+    '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.opus', '.png', '.rar', '.tgz', '.webm', '.webp',
+    '.xz', '.zip', '.zst'
+}
+SAMPLE_SIZE = 16 * 1024 # Bytes compressed to guess if a file is compressible
+MIN_SAMPLE_RATIO = 0.95 # Files whose sample doesn't shrink below this ratio are stored
+
+def parse_compression(compression: str) -> tuple[str, Optional[int]]:
+    """
+        Parse a compression setting, eg. "store", "deflate", "deflate:9", "lzma" or "zstd:19"
+        Returns the method and the level, or None for the default one
+    """
+    method, _, level = compression.partition(':')
+
+    if method not in COMPRESSION_METHODS:
+        raise ValueError('Invalid compression "' + compression + '". Valid methods: ' + ', '.join(COMPRESSION_METHODS))
+
+    levels = COMPRESSION_METHODS[method][1]
+
+    if level == '':
+        return method, None
+    elif levels is None or not level.isdigit() or int(level) not in levels:
+        raise ValueError('Invalid level for ' + method + ': ' + level)
+    else:
+        return method, int(level)
+
+def get_archive_name(compression: str):
+    """Name of the archive a compression setting produces"""
+    method, _ = parse_compression(compression)
+
+    return COMPRESSION_METHODS[method][0]
+
+def get_backup_name(archive_name: str, index: int):
+    """Name of a rotated backup. eg. backup.zip, backup.zip.1..."""
+    return archive_name if index == 0 else f'{archive_name}.{index}'
+
+def parse_backup_name(name: str) -> Optional[tuple[str, int]]:
+    """Get the archive name and rotation index of a backup, or None if it isn't one"""
+    for archive_name in ARCHIVE_NAMES:
+        if name == archive_name:
+            return archive_name, 0
+        elif name.startswith(archive_name + '.') and name[len(archive_name) + 1:].isdigit():
+            return archive_name, int(name[len(archive_name) + 1:])
+
+    return None
+
+def is_compressible(path):
+    """Guess if compressing a file is worth it, from its extension or by compressing its first bytes"""
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+
+    with open(path, 'rb') as file:
+        sample = file.read(SAMPLE_SIZE)
+
+    # Too small to tell
+    if len(sample) < 512:
+        return True
+
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_SAMPLE_RATIO
+
+def open_archive_writer(file, compression: str):
+    """
+        Create the writer of an archive for a compression setting
+        - file: Path of the archive, or file object to write it to. It only needs write and tell
+    """
+    import zipfile
+    method, level = parse_compression(compression)
+
+    if method == 'zstd':
+        return TarZstdWriter(file, level)
+    else:
+        return ParallelZipWriter(file, getattr(zipfile, _ZIP_COMPRESS_TYPES[method]), level)
+
+def extract_archive(path, target_dir):
+    """Extract a backup of any format"""
+    import tarfile
+    import zipfile
+
+    if os.path.basename(path).startswith(TAR_ZSTD_ARCHIVE):
+        with _open_tar_zstd(path) as tar:
+            for member in tar:
+                if member.name not in METADATA_NAMES:
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extract(member, target_dir, filter='data')
+                    else:
+                        tar.extract(member, target_dir)
+    else:
+        with zipfile.ZipFile(path, 'r') as zipf:
+            zipf.extractall(target_dir, [ name for name in zipf.namelist() if name not in METADATA_NAMES ])
+
+def read_manifest(path, archive_name=None) -> dict:
+    """
+        Read the manifest of a backup, a directory tree or an archive.
+        Only trees have the digests of their files in it, the ones of an archive are at its end
+        - path: Path of the backup, or seekable file with an archive
+        - archive_name: Name of the archive, eg. backup.zip, which tells its format. The name of the path if None
+    """
+    import zipfile
+    manifest = None
+    is_path = isinstance(path, (str, os.PathLike))
+    archive_name = os.path.basename(path) if archive_name is None else archive_name
+
+    if is_path and os.path.isdir(path):
+        if os.path.isfile(os.path.join(path, MANIFEST_NAME)):
+            with open(os.path.join(path, MANIFEST_NAME), 'r', encoding='utf8') as file:
+                manifest = json.load(file)
+    elif archive_name.startswith(TAR_ZSTD_ARCHIVE):
+        with _open_tar_zstd(path) as tar:
+            member = tar.next()
+
+            if member is not None and member.name == MANIFEST_NAME:
+                manifest = json.load(tar.extractfile(member))
+    else:
+        with zipfile.ZipFile(path, 'r') as zipf:
+            if MANIFEST_NAME in zipf.NameToInfo:
+                manifest = json.loads(zipf.read(MANIFEST_NAME))
+
+    return { 'type': 'full' } if manifest is None else manifest
+
+def is_under_paths(name, paths: list[str]) -> bool:
+    """Check if a member is one of some paths, or is under one of them"""
+    return any( name == path or name.startswith(path + '/') for path in paths )
+
+def extract_members(file, archive_name, target_dir, paths: list[str], exclude: set[str]) -> tuple[dict, set[str]]:
+    """
+        Extract the members of a backup under some paths, reading as little of it as possible.
+        A zip is read through its central directory, so only the directory and the extracted members
+        are read from the file. A tar.zst has no directory, so it's read until its end.
+        Returns the manifest of the backup, with the digests of its files, and the paths of the files extracted
+        - file: Seekable file with the backup. Reads of a tar.zst are sequential
+        - archive_name: Name of the archive, eg. backup.zip, which tells its format
+        - paths: Paths relative to the basepath. Directories are extracted with everything under them
+        - exclude: Paths of files not to extract, eg. because a newer backup has them
+    """
+    import tarfile
+    import zipfile
+
+    def is_selected(name):
+        name = name.rstrip('/')
+        return name not in METADATA_NAMES and name not in exclude and is_under_paths(name, paths)
+
+    manifest = None
+    digests = None
+    extracted = set()
+
+    if archive_name.startswith(TAR_ZSTD_ARCHIVE):
+        with _open_tar_zstd(file) as tar:
+            for member in tar:
+                if member.name == MANIFEST_NAME:
+                    manifest = json.load(tar.extractfile(member))
+                elif member.name == DIGESTS_NAME:
+                    digests = json.load(tar.extractfile(member))
+                elif is_selected(member.name):
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extract(member, target_dir, filter='data')
+                    else:
+                        tar.extract(member, target_dir)
+
+                    if not member.isdir():
+                        extracted.add(member.name)
+    else:
+        with zipfile.ZipFile(file, 'r') as zipf:
+            if MANIFEST_NAME in zipf.NameToInfo:
+                manifest = json.loads(zipf.read(MANIFEST_NAME))
+            if DIGESTS_NAME in zipf.NameToInfo:
+                digests = json.loads(zipf.read(DIGESTS_NAME))
+
+            members = [ info for info in zipf.infolist() if is_selected(info.filename) ]
+            zipf.extractall(target_dir, members)
+            extracted.update( info.filename for info in members if not info.is_dir() )
+
+    manifest = { 'type': 'full' } if manifest is None else manifest
+
+    if digests is not None:
+        manifest['digests'] = digests
+
+    return manifest, extracted
+
+@contextmanager
+def _open_tar_zstd(file):
+    """Open a zstd compressed tar to be read sequentially, from a path or a file"""
+    import tarfile
+    zstandard = _import_zstandard()
+    closefd = isinstance(file, (str, os.PathLike))
+
+    with zstandard.ZstdDecompressor().stream_reader(open(file, 'rb') if closefd else file, closefd=closefd) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            yield tar
+
+def _import_zstandard():
+    """zstandard is only needed by groups using zstd, so it's imported on demand"""
+    try:
+        import zstandard # pylint: disable=import-outside-toplevel
+    except ImportError as err:
+        raise ValueError('zstd compression requires the zstandard package (pip install zstandard).') from err
+
+    return zstandard
+
+def _deflate_chunk(data: bytes, level: int, zdict, last: bool) -> bytes:
+    """
+        Compress a chunk of a member as raw deflate data.
+        Chunks other than the last one end in a sync flush, so they can be concatenated
+        into a single stream, and are primed with the tail of the previous chunk to keep the ratio
+    """
+    if zdict is None:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class ParallelZipWriter:
+    """
+        Zip writer that compresses members on a thread pool.
+        Members are read in chunks which are deflated in parallel, both within a large member
+        and across members, and written to the zip in the order they were added, so the output
+        doesn't depend on the number of threads.
+        Members are written with a data descriptor, so the output doesn't need to be seekable.
+        LZMA members are written by zipfile itself, in the calling thread.
+    """
+    CHUNK_SIZE = 4 * 1024 * 1024 # Bytes of a member compressed by each job
+    WINDOW_SIZE = 32 * 1024 # Deflate window, primed with the tail of the previous chunk
+
+    def __init__(self, file, compression=None, compresslevel=None, jobs=None):
+        import zipfile
+        from concurrent.futures import ThreadPoolExecutor
+        compression = zipfile.ZIP_DEFLATED if compression is None else compression
+        self._zipf = zipfile.ZipFile(file, 'w', compression)
+        self._compression = compression
+        self.compresses_members = compression != zipfile.ZIP_STORED
+        self._level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+        self._jobs = hashing.get_jobs() if jobs is None else jobs
+        self._executor = ThreadPoolExecutor(max_workers=self._jobs)
+        # Writes waiting for their turn, in output order
+        self._pending_writes = deque()
+        self._in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(cancel_futures=True)
+            self._zipf.close()
+
+    def write_dir(self, path, arcname):
+        """Add a directory entry"""
+        import zipfile
+        zinfo = zipfile.ZipInfo.from_file(path, arcname=arcname)
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+
+        self._pending_writes.append((self._write_header, zinfo, False))
+        self._pending_writes.append((self._write_end, zinfo, False))
+
+    def write_data(self, arcname, data: bytes):
+        """Add a member from memory"""
+        import zipfile
+        self._flush(0)
+        # Fixed date so the same data always produces the same archive
+        self._zipf.writestr(zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0)), data)
+
+    def write_file(self, path, arcname, on_block=None, compress=True):
+        """
+            Add a file, compressing it in the thread pool
+            - on_block: Called with every block read, to process the file in the same read
+            - compress: If False, the file is stored without compression
+        """
+        import zipfile
+        zinfo = zipfile.ZipInfo.from_file(path, arcname=arcname)
+        zinfo.compress_type = self._compression if compress else zipfile.ZIP_STORED
+
+        if zinfo.compress_type == zipfile.ZIP_LZMA:
+            self._write_file_with_zipfile(path, zinfo, on_block)
+            return
+
+        zinfo.flag_bits |= 0x08 # CRC and sizes are written in a data descriptor after the data
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        # Compressed size can be larger than uncompressed size
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        crc = 0
+        file_size = 0
+
+        self._pending_writes.append((self._write_header, zinfo, zip64))
+
+        with open(path, 'rb') as file:
+            data = file.read(self.CHUNK_SIZE)
+            zdict = None
+
+            while True:
+                # Peek the next chunk, since the last one is flushed differently
+                next_data = file.read(self.CHUNK_SIZE) if len(data) == self.CHUNK_SIZE else b''
+                last = not next_data
+
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+
+                if on_block is not None:
+                    on_block(data)
+
+                if zinfo.compress_type == zipfile.ZIP_STORED:
+                    self._pending_writes.append((self._write_data, zinfo, data))
+                else:
+                    self._pending_writes.append(
+                        (self._write_data, zinfo, self._executor.submit(_deflate_chunk, data, self._level, zdict, last))
+                    )
+
+                self._in_flight += 1
+                self._flush(self._jobs * 2)
+
+                if last:
+                    break
+
+                zdict = data[-self.WINDOW_SIZE:]
+                data = next_data
+
+        if not zip64 and file_size > zipfile.ZIP64_LIMIT:
+            raise RuntimeError('File ' + path + ' has grown too large while zipping it.')
+
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+
+        self._pending_writes.append((self._write_end, zinfo, zip64))
+
+    def _write_file_with_zipfile(self, path, zinfo: 'zipfile.ZipInfo', on_block):
+        """Write a file using the compressors of zipfile"""
+        self._flush(0)
+
+        with self._zipf.open(zinfo, 'w') as member:
+            for block in hashing.read_blocks(path):
+                member.write(block)
+
+                if on_block is not None:
+                    on_block(block)
+
+    def close(self):
+        """Write everything left and the central directory"""
+        self._flush(0)
+        self._executor.shutdown()
+        self._zipf.close()
+
+    def _flush(self, max_in_flight):
+        """Write pending data until at most max_in_flight chunks are left"""
+        while self._pending_writes and (max_in_flight == 0 or self._in_flight > max_in_flight):
+            write, zinfo, arg = self._pending_writes.popleft()
+            write(zinfo, arg)
+
+    def _write_header(self, zinfo: 'zipfile.ZipInfo', zip64: bool):
+        zinfo.header_offset = self._zipf.fp.tell()
+        # pylint: disable=protected-access
+        self._zipf._writecheck(zinfo)
+        self._zipf._didModify = True
+        self._zipf.fp.write(zinfo.FileHeader(zip64))
+
+    def _write_data(self, zinfo: 'zipfile.ZipInfo', data):
+        # Deflated chunks are futures of the thread pool
+        if not isinstance(data, bytes):
+            data = data.result()
+
+        self._in_flight -= 1
+
+        zinfo.compress_size += len(data)
+        self._zipf.fp.write(data)
+
+    def _write_end(self, zinfo: 'zipfile.ZipInfo', zip64: bool):
+        if zinfo.flag_bits & 0x08:
+            fmt = '<LLQQ' if zip64 else '<LLLL'
+            self._zipf.fp.write(struct.pack(fmt, _DD_SIGNATURE, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+
+        self._zipf.start_dir = self._zipf.fp.tell()
+        self._zipf.filelist.append(zinfo)
+        self._zipf.NameToInfo[zinfo.filename] = zinfo
+
+class _ReadObserver:
+    """File wrapper that passes every block read to a callback"""
+    def __init__(self, file, on_block):
+        self._file = file
+        self._on_block = on_block
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._on_block(data)
+
+        return data
+
+class TarZstdWriter:
+    """
+        Writer of zstd compressed tars
+        The compression runs on the worker threads of zstd itself
+    """
+    DEFAULT_LEVEL = 3
+    compresses_members = False # The compress argument of write_file is ignored
+
+    def __init__(self, file, compresslevel=None, jobs=None):
+        zstandard = _import_zstandard()
+        compressor = zstandard.ZstdCompressor(
+            level=self.DEFAULT_LEVEL if compresslevel is None else compresslevel,
+            threads=hashing.get_jobs() if jobs is None else jobs
+        )
+
+        if isinstance(file, str):
+            self._stream = compressor.stream_writer(open(file, 'wb'))
+        else:
+            # The file object is closed by its owner
+            self._stream = compressor.stream_writer(file, closefd=False)
+        # Follow symlinks, like zips do
+        import tarfile
+        self._tar = tarfile.open(fileobj=self._stream, mode='w|', dereference=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_dir(self, path, arcname):
+        """Add a directory entry"""
+        self._tar.addfile(self._tar.gettarinfo(path, arcname))
+
+    def write_data(self, arcname, data: bytes):
+        """Add a member from memory"""
+        import tarfile
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = len(data)
+
+        self._tar.addfile(tarinfo, io.BytesIO(data))
+
+    def write_file(self, path, arcname, on_block=None, compress=True):
+        """
+            Add a file
+            - on_block: Called with every block read, to process the file in the same read
+            - compress: Ignored, the whole tar is compressed as a single stream
+        """
+        tarinfo = self._tar.gettarinfo(path, arcname)
+
+        with open(path, 'rb') as file:
+            self._tar.addfile(tarinfo, file if on_block is None else _ReadObserver(file, on_block))
+
+    def close(self):
+        self._tar.close()
+        self._stream.close()
@@ -1,9 +1,10 @@
 #!/usr/bin/scripts/backup/.venv/bin/python
 import argparse
+import hashing
+import transfers
 from config import Config
 from filegroup import FileGroup
-from backup_manager import BackupManager, ManagerType
-from backup_managers.manager_drive import get_remote_file, upload_remote_file, delete_remote_file
+from backup_manager import BackupManager, ManagerType, load_drive
 from utils import ask_for_confirmation
 
 def get_parser():
@@ -16,10 +17,10 @@ def get_parser():
             removefile <group name> <relative filepath>
             setproperty <group name> <attribute name> <attribute value>
             backup <group name>
-            get <group name> <target directory>
+            get <group name> <target directory> [--path <path>]...
             getall
             saveall
-            restore <group name>
+            restore <group name> [paths]
             remoteget <file id> <target directory>
             remoteupload <filepath>
             remoteremove <file id>
@@ -63,22 +64,38 @@ def get_parser():
     backup_group_parser.add_argument("group_name", type=str, help="Name of the group to backup")
     # --force
     backup_group_parser.add_argument('--force', action='store_true', help='Force the backup')
+    # --paranoid
+    backup_group_parser.add_argument('--paranoid', action='store_true', help='Rehash every file instead of trusting unchanged stats')
+    # --jobs
+    backup_group_parser.add_argument('--jobs', type=int, default=None, help='Number of threads used to hash and compress files')
 
     # get
     get_group_backup_parser = subparsers.add_parser("get", help="Copy the latest backup a group to a directory")
     get_group_backup_parser.add_argument("group_name", type=str, help="Name of the group")
     get_group_backup_parser.add_argument("target_dir", type=str, help="Target directory")
+    # --path
+    get_group_backup_parser.add_argument('--path', dest='paths', action='append', default=None,
+                                         help='Only extract this path relative to the basepath. Can be repeated')
 
     # getall
     get_all_parser = subparsers.add_parser('getall', help="Copy all the files to a directory")
     get_all_parser.add_argument("target_dir", type=str, help="Target directory")
+    # --transfers
+    get_all_parser.add_argument('--transfers', type=int, default=None, help='Number of backups downloaded at the same time')
 
     # saveall
     get_all_parser = subparsers.add_parser('saveall', help="Backup all groups")
+    # --paranoid
+    get_all_parser.add_argument('--paranoid', action='store_true', help='Rehash every file instead of trusting unchanged stats')
+    # --jobs
+    get_all_parser.add_argument('--jobs', type=int, default=None, help='Number of threads used to hash and compress files')
+    # --transfers
+    get_all_parser.add_argument('--transfers', type=int, default=None, help='Number of backups uploaded at the same time')
 
     # group restore
     restore_group_parser = subparsers.add_parser("restore", help="Restore a group backup")
     restore_group_parser.add_argument("group_name", type=str, help="Name of the group to restore")
+    restore_group_parser.add_argument("paths", type=str, nargs='*', help="Paths relative to the basepath to restore. Everything if none")
 
     # remote get
     remote_get_parser = subparsers.add_parser('remoteget', help='Get a remote file')
@@ -137,24 +154,24 @@ def set_group_property(group_name, property_name, property_value, config: Config
     group = get_group(group_name, config)
     group.set_property(property_name, property_value)
 
-def backup_group(group_name, config: Config, force_if_unchanged=False):
+def backup_group(group_name, config: Config, force_if_unchanged=False, paranoid=False):
     """
         Backup the files of a group
     """
     group = get_group(group_name, config)
-    group.backup(config.get_rotation_number(), force_if_unchanged=force_if_unchanged)
+    group.backup(config.get_rotation_number(), force_if_unchanged=force_if_unchanged, paranoid=paranoid)
 
-def backup_all_groups(config: Config):
+def backup_all_groups(config: Config, paranoid=False):
     for group in config.get_groups():
         print()
-        group.backup(config.get_rotation_number(), force_if_unchanged=False)
+        group.backup(config.get_rotation_number(), force_if_unchanged=False, paranoid=paranoid)
 
-def get_backup(group_name, target_dir, config: Config):
+def get_backup(group_name, target_dir, config: Config, paths=None):
     """
-        Get the latest backup of a group
+        Get the latest backup of a group, or only some paths of it
     """
     group = get_group(group_name, config)
-    group.get_latest_backup(target_dir)
+    group.get_latest_backup(target_dir, paths)
 
 def get_all_backups(target_dir, config: Config):
     for group in config.get_groups():
@@ -164,13 +181,13 @@ def get_all_backups(target_dir, config: Config):
 def list_current_backups(manager_type: ManagerType):
     BackupManager(None, manager_type).list_backups()
 
-def restore_group(group_name, config: Config):
+def restore_group(group_name, config: Config, paths=None):
     """
-        Restore the files of a group
+        Restore the files of a group, or only some paths of it
     """
     group = get_group(group_name, config)
 
-    group.restore()
+    group.restore(paths)
 
 def main():
     parser = get_parser()
@@ -199,24 +216,38 @@ def main():
     elif args.command == 'setproperty':
         set_group_property(args.group_name, args.group_property, args.group_property_value, config)
     elif args.command == 'get':
-        get_backup(args.group_name, args.target_dir, config)
+        get_backup(args.group_name, args.target_dir, config, args.paths)
     elif args.command == 'getall':
+        if args.transfers is not None:
+            transfers.set_max_in_flight(args.transfers)
+
         get_all_backups(args.target_dir, config)
     elif args.command == 'save':
-        backup_group(args.group_name, config, force_if_unchanged=args.force)
+        if args.jobs is not None:
+            hashing.set_jobs(args.jobs)
+
+        backup_group(args.group_name, config, force_if_unchanged=args.force, paranoid=args.paranoid)
     elif args.command == 'saveall':
-        backup_all_groups(config)
+        if args.jobs is not None:
+            hashing.set_jobs(args.jobs)
+        if args.transfers is not None:
+            transfers.set_max_in_flight(args.transfers)
+
+        backup_all_groups(config, paranoid=args.paranoid)
     elif args.command == 'restore':
-        restore_group(args.group_name, config)
+        restore_group(args.group_name, config, args.paths)
     elif args.command == 'remoteget':
-        get_remote_file(args.file_id, args.target_dir)
+        load_drive().get_remote_file(args.file_id, args.target_dir)
     elif args.command == 'remoteupload':
-        upload_remote_file(args.filename)
+        load_drive().upload_remote_file(args.filename)
     elif args.command == 'remotedel':
-        delete_remote_file(args.file_id)
+        load_drive().delete_remote_file(args.file_id)
     else:
         raise ValueError('Invalid command: ' + args.command)
 
+    # Some managers upload and download in the background
+    transfers.wait()
+
     # Detect changes on config
     if start_config != str(config):
         config.save()
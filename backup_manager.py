@@ -1,17 +1,26 @@
 import os
-import zipfile
-import shutil
+import json
 import tempfile
 from enum import Enum
+from typing import Optional
+import hashing
+import archive
+import copying
+import transfers
 from file import File, Filetype
-from backup_managers.manager_local import ManagerLocal
-from backup_managers.manager_drive import ManagerDrive
-from backup_managers.abstract_manager import AbstractManager
+from backup_managers.abstract_manager import AbstractManager, ArchiveSink
 from utils import ask_for_confirmation
 
 class ManagerType(Enum):
     LOCAL = 'LOCAL'
     DRIVE = 'DRIVE'
+    CAS = 'CAS'
+
+def load_drive():
+    """Import the Drive backend. It's imported on demand, since the Google client takes a while to import"""
+    from backup_managers import manager_drive # pylint: disable=import-outside-toplevel
+
+    return manager_drive
 
 class BackupManager():
     def __init__(self, group, manager_type: ManagerType):
@@ -19,13 +28,22 @@ class BackupManager():
 
         self._manager: AbstractManager = self.build_manager_from_type(manager_type)
 
+    def supports_trees(self) -> bool:
+        return self._manager.SUPPORTS_TREES
+
     def build_manager_from_type(self, manager_type: ManagerType) -> AbstractManager:
         group_name = 'NO_GROUP' if self.group is None else self.group.get_name()
 
+        # Only the backend of the group is imported
+        # pylint: disable=import-outside-toplevel
         if manager_type == ManagerType.LOCAL:
+            from backup_managers.manager_local import ManagerLocal
             return ManagerLocal(group_name)
         elif manager_type == ManagerType.DRIVE:
-            return ManagerDrive(group_name)
+            return load_drive().ManagerDrive(group_name)
+        elif manager_type == ManagerType.CAS:
+            from backup_managers.manager_cas import ManagerCAS
+            return ManagerCAS(group_name)
         else:
             raise ValueError('Incorrect manager type: ' + manager_type.value)
 
@@ -46,11 +64,24 @@ class BackupManager():
 
         return True
 
-    def _zip_files(self, zip_path):
-        """Zip all the files in a group"""
-        self.group.log('...Zipping files')
+    def _archive_files(self, sink: ArchiveSink, pending: list[str], manifest: dict, selection: Optional[set[str]]) -> dict[str, bytes]:
+        """
+            Archive the files in a group
+            The pending paths are hashed from the same reads used to compress them.
+            The digest of every archived file is recorded in the archive, see archive.DIGESTS_NAME.
+            Returns the digests of the pending paths
+            - manifest: Description of the backup, see FileGroup._plan_backup
+            - selection: Paths relative to the basepath to archive. All of them if None
+        """
+        self.group.log(f'...Archiving files ({self.group.get_compression() if self.group.get_layout() == "archive" else "tree"})')
+
+        pending = set(pending)
+        digests = {}
+        recorded = {} # Digest of every archived file by arcname, None until it's known
+
+        with sink.open_writer(self.group.get_compression()) as writer:
+            writer.write_data(archive.MANIFEST_NAME, json.dumps(manifest).encode('utf8'))
 
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for file in self.group.get_files():
                 #Skip file if it doesn't exist, since it should have asked for confirmation before
                 if file.exists():
@@ -61,23 +92,94 @@ class BackupManager():
                             paths += [ os.path.join(root, f) for f in file_list ]
 
                         for path in paths:
-                            zipf.write(path, arcname=os.path.relpath(path, self.group.get_basepath()))
-                    else:
-                        zipf.write(file.get_filepath(), arcname=file.get_relpath())
+                            arcname = os.path.relpath(path, self.group.get_basepath())
 
-    def backup(self, rotation_number: int):
-        self.group.log('...Creating backup')
+                            # Partial backups only have the selected files. Directories are created on extraction
+                            if selection is None or arcname in selection:
+                                self._archive_member(writer, file, path, arcname, pending, digests, recorded)
+                    elif selection is None or file.get_relpath() in selection:
+                        self._archive_member(writer, file, file.get_filepath(), file.get_relpath(), pending, digests, recorded)
 
-        temp_dir = tempfile.TemporaryDirectory()
-        zip_path = os.path.join(temp_dir.name, self.group.get_name() + '.zip')
+            # The files that weren't pending have the digest found by the scan
+            scanned = {}
+
+            for file in self.group.get_files():
+                if file.exists():
+                    scanned.update(file.get_scanned_digests())
+
+            recorded = { arcname: scanned.get(arcname) if digest is None else digest for arcname, digest in recorded.items() }
+            writer.write_data(archive.DIGESTS_NAME, json.dumps(recorded).encode('utf8'))
+
+        # Pending paths that weren't archived, like the ones under symlinked directories
+        digests.update(hashing.digest_files([ path for path in pending if path not in digests ]))
+
+        return digests
+
+    def _archive_member(self, writer, file: File, path, arcname, pending: set[str], digests: dict[str, bytes], recorded: dict[str, Optional[str]]):
+        """
+            Write a path to the archive, hashing it on the way if it's pending, and record its digest
+            Files that won't shrink, like images or other archives, aren't compressed. That's only
+            checked for the writers that compress each member on its own
+        """
+        if os.path.isdir(path):
+            writer.write_dir(path, arcname)
+            return
+
+        compress = file.is_compressible(path) if writer.compresses_members else True
+
+        if path in pending:
+            _hash = hashing.new_file_hash(path)
+            writer.write_file(path, arcname, on_block=_hash.update, compress=compress)
+            digests[path] = _hash.hexdigest().encode('utf8')
+            recorded[arcname] = digests[path].decode('utf8')
+        else:
+            writer.write_file(path, arcname, compress=compress)
+            recorded[arcname] = None
+
+    def create_backup(self, pending: list[str], manifest: dict, selection: Optional[set[str]] = None) -> Optional[dict[str, bytes]]:
+        """
+            Archive the group straight to the manager, to be committed or discarded afterwards.
+            Returns the digests of the pending paths, or None if the user has decided to not continue
+        """
+        self.group.log('...Creating backup')
 
         # If all files exists or the user has decided to continue anyways
-        if self._check_files():
-            self._zip_files(zip_path)
+        if not self._check_files():
+            return None
+
+        self._manager.create_dir()
+
+        if self.group.get_layout() == 'tree':
+            self._sink = self._manager.open_tree_snapshot(self.group.get_files())
+        else:
+            self._sink = self._manager.open_sink(archive.get_archive_name(self.group.get_compression()))
 
-            self._manager.create_dir()
-            self._manager.rotate_files(rotation_number)
-            self._manager.move_zip(zip_path)
+        try:
+            digests = self._archive_files(self._sink, pending, manifest, selection)
+            self._sink.close()
+        except BaseException:
+            self._sink.abort()
+            raise
+
+        return digests
+
+    def commit_backup(self, rotation_number: int):
+        """
+            Store the backup created by create_backup as the latest one, and remove the ones that expire
+            If the manager allows it, it's stored in the background. See transfers.wait
+        """
+        if self._manager.CONCURRENT_TRANSFERS:
+            transfers.submit(f'{self.group.get_name()} backup', self._commit, self._sink, rotation_number)
+        else:
+            self._commit(self._sink, rotation_number)
+
+    def _commit(self, sink: ArchiveSink, rotation_number: int):
+        sink.commit()
+        self._manager.rotate_files(rotation_number)
+
+    def discard_backup(self):
+        """Remove the backup created by create_backup"""
+        self._sink.abort()
 
     def clean_backups(self):
         self.group.log('...Cleaning backups')
@@ -86,9 +188,134 @@ class BackupManager():
     def list_backups(self):
         self._manager.list_backups()
 
+    def read_latest_manifest(self) -> Optional[dict]:
+        """Read the manifest of the latest backup, or None if there are no backups"""
+        return self._manager.read_manifest(0)
+
+    def _copy_backup_chain(self, target_dir, temp_dir) -> Optional[list[str]]:
+        """
+            Copy the latest backup to target_dir, and the older ones it's based on to temp_dir.
+            Returns their paths from the oldest to the latest, or None if there are no backups
+        """
+        latest_path = self._manager.copy_backup(target_dir, 0)
+
+        if latest_path is None:
+            return None
+
+        manifest = archive.read_manifest(latest_path)
+
+        if manifest['type'] == 'full':
+            return [latest_path]
+
+        # Incremental backups depend on every backup since the full one, differential ones only on the full one
+        if manifest['type'] == 'differential':
+            indexes = [manifest['since_full']]
+        else:
+            indexes = range(manifest['since_full'], 0, -1)
+
+        chain = [ self._manager.copy_backup(temp_dir, index) for index in indexes ] + [latest_path]
+
+        if None in chain:
+            raise ValueError('Couldn\'t rebuild the latest backup: Some of the backups it depends on are missing.')
+        elif archive.read_manifest(chain[0])['type'] != 'full':
+            raise ValueError('Couldn\'t rebuild the latest backup: The oldest backup it depends on isn\'t a full one.')
+
+        return chain
+
+    def _extract_backup_chain(self, chain: list[str], target_dir):
+        """Extract a chain of backups, from the oldest to the latest"""
+        for archive_path in chain:
+            self._extract_archive(target_dir, archive_path)
+
+            for relpath in archive.read_manifest(archive_path).get('deleted', []):
+                path = os.path.join(target_dir, relpath)
+
+                if os.path.isfile(path):
+                    os.remove(path)
+
     def get_latest_backup(self, target_dir):
+        """
+            Copy the latest backup to a directory, returning its path
+            If it's a partial backup, it's rebuilt into a full one
+        """
         self.group.log(f'...Getting latest backup to {target_dir}')
-        self._manager.copy_latest_backup(target_dir)
+
+        temp_dir = tempfile.TemporaryDirectory()
+        chain = self._copy_backup_chain(target_dir, temp_dir.name)
+
+        if chain is not None and len(chain) > 1:
+            self.group.log(f'...Rebuilding it from {len(chain)} backups')
+
+            files_dir = os.path.join(temp_dir.name, 'files')
+            self._extract_backup_chain(chain, files_dir)
+
+            # It's rebuilt with the current compression, which may be a different format than the latest backup
+            rebuilt_name = archive.get_archive_name(self.group.get_compression())
+            rebuilt_path = os.path.join(temp_dir.name, rebuilt_name)
+
+            with archive.open_archive_writer(rebuilt_path, self.group.get_compression()) as writer:
+                for root, dirs, file_list in os.walk(files_dir):
+                    for d in dirs:
+                        writer.write_dir(os.path.join(root, d), os.path.relpath(os.path.join(root, d), files_dir))
+                    for f in file_list:
+                        writer.write_file(os.path.join(root, f), os.path.relpath(os.path.join(root, f), files_dir))
+
+            os.remove(chain[-1])
+            chain[-1] = os.path.join(target_dir, rebuilt_name)
+            copying.move(rebuilt_path, chain[-1])
+
+        return None if chain is None else chain[-1]
+
+    def _extract_latest_paths(self, target_dir, paths: list[str]) -> Optional[dict[str, Optional[str]]]:
+        """
+            Extract the files under some paths as they are in the latest backup, without copying whole backups.
+            If it's a partial backup, each file is taken from the latest backup of its chain that has it.
+            Returns the paths of the files extracted with the digests recorded by the backups they were taken from,
+            or None if there are no backups
+        """
+        latest = self._manager.extract_backup(0, target_dir, paths, set())
+
+        if latest is None:
+            return None
+
+        manifest, extracted = latest
+        digests = { relpath: manifest.get('digests', {}).get(relpath) for relpath in extracted }
+        # Files extracted from a later backup, or deleted since an earlier one, are skipped
+        skipped = extracted | set(manifest.get('deleted', []))
+
+        if manifest['type'] == 'full':
+            indexes = []
+        elif manifest['type'] == 'differential':
+            indexes = [manifest['since_full']]
+        else:
+            indexes = range(1, manifest['since_full'] + 1)
+
+        for index in indexes:
+            backup = self._manager.extract_backup(index, target_dir, paths, skipped)
+
+            if backup is None:
+                raise ValueError('Couldn\'t extract files: Some of the backups the latest one depends on are missing.')
+
+            manifest, backup_extracted = backup
+
+            if index == indexes[-1] and manifest['type'] != 'full':
+                raise ValueError('Couldn\'t extract files: The oldest backup the latest one depends on isn\'t a full one.')
+
+            digests.update( (relpath, manifest.get('digests', {}).get(relpath)) for relpath in backup_extracted )
+            skipped |= backup_extracted | set(manifest.get('deleted', []))
+
+        return digests
+
+    def get_latest_paths(self, target_dir, paths: list[str]):
+        """Extract some paths relative to the basepath from the latest backup to a directory"""
+        self.group.log(f'...Getting {", ".join(paths)} from the latest backup to {target_dir}')
+
+        extracted = self._extract_latest_paths(target_dir, paths)
+
+        if extracted is None:
+            raise ValueError('Couldn\'t get files: There are no backups.')
+
+        self.group.log(f'...Extracted {len(extracted)} files')
 
     def get_all_backups(self, target_dir):
         group_dir = os.path.join(target_dir, self.group.get_name())
@@ -97,10 +324,9 @@ class BackupManager():
         os.makedirs(group_dir, exist_ok=True)
         self._manager.copy_all_backups(group_dir)
 
-    def _extract_zip(self, target_dir, filename):
-        self.group.log('...Extracting zip')
-        with zipfile.ZipFile(os.path.join(target_dir, filename), 'r') as zipf:
-            zipf.extractall(target_dir)
+    def _extract_archive(self, target_dir, archive_path):
+        self.group.log('...Extracting ' + os.path.basename(archive_path))
+        archive.extract_archive(archive_path, target_dir)
 
     def _digest_coincides(self, target_dir):
         """Check if the digest for all the files present in target_dir coincide"""
@@ -118,32 +344,114 @@ class BackupManager():
 
         return True
 
-    def restore(self):
-        # First uncompress in a temporary folder in case there is any error
+    def _check_digests(self, files_dir, digests: dict[str, Optional[str]]):
+        """Check that the files in files_dir match their recorded digests. Files without one fail too"""
+        for relpath, digest in digests.items():
+            if digest is None:
+                self.group.log(f'Digest check failed: {relpath} has no recorded digest')
+                raise ValueError('Couldn\'t restore files: Digest doesn\'t match.')
+
+            actual_digest = hashing.file_digest(os.path.join(files_dir, relpath)).decode('utf-8')
+
+            if digest != actual_digest:
+                self.group.log(f'Digest check failed: {relpath} {digest} != {actual_digest}')
+                raise ValueError('Couldn\'t restore files: Digest doesn\'t match.')
+
+    def _restore_paths(self, paths: list[str]):
+        """Restore only the files under some paths relative to the basepath"""
         temp_dir = tempfile.TemporaryDirectory()
 
-        self.get_latest_backup(temp_dir.name)
-        self._extract_zip(temp_dir.name, 'backup.zip')
+        self.group.log(f'...Extracting {", ".join(paths)} from the latest backup to {temp_dir.name}')
+        extracted = self._extract_latest_paths(temp_dir.name, paths)
 
-        if self._digest_coincides(temp_dir.name):
-            # Move files to be replaced to a temporary directory just in case
-            replaced_files_dir = os.path.join(tempfile.gettempdir(), 'replaced_files')
-            os.makedirs(replaced_files_dir, exist_ok=True)
+        if extracted is None:
+            raise ValueError('Couldn\'t restore files: There are no backups.')
+        elif not extracted:
+            raise ValueError('Couldn\'t restore files: None of the paths are in the latest backup.')
 
-            self.group.log('...Copying files from temp')
-            for file in self.group.get_files():
-                filepath_in_temp = os.path.join(temp_dir.name, file.get_relpath())
-                filepath_in_replaced_files_dir = os.path.join(replaced_files_dir, file.get_relpath())
+        self._check_digests(temp_dir.name, extracted)
 
-                if os.path.exists(filepath_in_temp):
-                    if file.exists():
-                        # Move file to temporary dir
-                        shutil.move(file.get_filepath(), filepath_in_replaced_files_dir)
+        # Move files to be replaced to a temporary directory just in case
+        replaced_files_dir = os.path.join(tempfile.gettempdir(), 'replaced_files')
 
-                    # Move extracted file to original path
-                    shutil.move(filepath_in_temp, file.get_filepath())
-                    self.group.log(f'...Restored {file.get_relpath()}')
+        for relpath in sorted(extracted):
+            filepath = os.path.join(self.group.get_basepath(), relpath)
 
-            self.group.log(f'...Previous files moved to {replaced_files_dir}')
+            if os.path.lexists(filepath):
+                os.makedirs(os.path.dirname(os.path.join(replaced_files_dir, relpath)), exist_ok=True)
+                copying.move(filepath, os.path.join(replaced_files_dir, relpath))
+
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            copying.move(os.path.join(temp_dir.name, relpath), filepath)
+
+            self.group.log(f'...Restored {relpath}')
+
+        self.group.log(f'...Previous files moved to {replaced_files_dir}')
+
+    def restore(self, paths: Optional[list[str]] = None):
+        """
+            Restore the files of the latest backup, replacing the current ones
+            - paths: Paths relative to the basepath to restore, only reading their files from the backups. Everything if None
+        """
+        if paths:
+            self._restore_paths(paths)
+            return
+
+        tree_path = self._manager.get_tree(0)
+
+        # Trees are always full, so their files are restored from them in place once they are checked
+        if tree_path is not None:
+            self.group.log(f'...Checking latest backup {tree_path}')
+            self._check_digests(tree_path, archive.read_manifest(tree_path).get('digests', {}))
+            # The files of a tree are shared with the backups, so they are copied
+            self._replace_files(tree_path, _copy_from_tree)
+            return
+
+        # First uncompress in a temporary folder in case there is any error
+        temp_dir = tempfile.TemporaryDirectory()
+        files_dir = os.path.join(temp_dir.name, 'files')
+
+        self.group.log(f'...Getting latest backup to {temp_dir.name}')
+        chain = self._copy_backup_chain(temp_dir.name, temp_dir.name)
+
+        if chain is None:
+            raise ValueError('Couldn\'t restore files: There are no backups.')
+
+        self._extract_backup_chain(chain, files_dir)
+
+        if self._digest_coincides(files_dir):
+            self._replace_files(files_dir, copying.move)
         else:
             raise ValueError('Couldn\'t restore files: Digest doesn\'t match.')
+
+    def _replace_files(self, files_dir, place):
+        """
+            Replace the files of the group with the ones in files_dir
+            - place: Called with the path of a file in files_dir and the path it's restored to
+        """
+        # Move files to be replaced to a temporary directory just in case
+        replaced_files_dir = os.path.join(tempfile.gettempdir(), 'replaced_files')
+        os.makedirs(replaced_files_dir, exist_ok=True)
+
+        self.group.log(f'...Copying files from {files_dir}')
+        for file in self.group.get_files():
+            filepath_in_temp = os.path.join(files_dir, file.get_relpath())
+            filepath_in_replaced_files_dir = os.path.join(replaced_files_dir, file.get_relpath())
+
+            if os.path.exists(filepath_in_temp):
+                if file.exists():
+                    # Move file to temporary dir
+                    copying.move(file.get_filepath(), filepath_in_replaced_files_dir)
+
+                place(filepath_in_temp, file.get_filepath())
+
+                self.group.log(f'...Restored {file.get_relpath()}')
+
+        self.group.log(f'...Previous files moved to {replaced_files_dir}')
+
+def _copy_from_tree(source, target):
+    """Copy a file or directory of a tree backup, whose files are read only"""
+    if os.path.isdir(source):
+        copying.copy_tree(source, target, copy_function=copying.copy_writable)
+    else:
+        copying.copy_writable(source, target)
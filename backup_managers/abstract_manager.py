@@ -1,6 +1,89 @@
 from abc import ABC, abstractmethod
+from typing import Optional, BinaryIO
+import archive
+
+class ArchiveSink(ABC):
+    """
+        Destination of an archive as it's written, so it doesn't have to be written somewhere else first.
+        It's written sequentially and closed, and then either committed as the latest backup or aborted.
+        It can't seek, but it can tell its position, which is all the archive writers need
+    """
+    def __init__(self):
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._write(data)
+        self._position += len(data)
+
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        ...
+
+    def open_writer(self, compression: str):
+        """Open the writer of the archive, see archive.open_archive_writer"""
+        return archive.open_archive_writer(self, compression)
+
+    @abstractmethod
+    def _write(self, data):
+        ...
+
+    @abstractmethod
+    def close(self):
+        """Finish writing the archive"""
+        ...
+
+    @abstractmethod
+    def commit(self):
+        """Store the closed archive as the latest backup, once the older ones have been rotated"""
+        ...
+
+    @abstractmethod
+    def abort(self):
+        """Remove the archive, closed or not"""
+        ...
+
+class MemberSink(ArchiveSink):
+    """
+        Sink that stores the files of a backup on their own instead of as an archive.
+        It's written file by file, like an archive, so it's its own writer
+    """
+    compresses_members = False # Files are stored as they are
+
+    def open_writer(self, compression: str):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ...
+
+    def _write(self, data):
+        raise ValueError(f'{type(self).__name__} is written file by file.')
+
+    @abstractmethod
+    def write_dir(self, path, arcname):
+        ...
+
+    @abstractmethod
+    def write_data(self, arcname, data: bytes):
+        ...
+
+    @abstractmethod
+    def write_file(self, path, arcname, on_block=None, compress=True):
+        ...
 
 class AbstractManager(ABC):
+    # Whether the backups can be committed and copied in the background, at the same
+    # time as other transfers. See transfers.py
+    CONCURRENT_TRANSFERS = False
+    # Whether groups can use the tree layout. See open_tree_snapshot
+    SUPPORTS_TREES = False
+
     @abstractmethod
     def __init__(self, group_name: str):
         ...
@@ -15,16 +98,65 @@ class AbstractManager(ABC):
 
     @abstractmethod
     def rotate_files(self, rotation_number: int):
+        """Remove the backups older than the latest one and rotation_number more"""
+        ...
+
+    @abstractmethod
+    def open_sink(self, archive_name: str) -> ArchiveSink:
+        """Open the destination of a new backup, eg. backup.zip. The group directory has to exist"""
         ...
 
+    def open_tree_snapshot(self, files: list) -> ArchiveSink:
+        """Open the destination of a new backup stored as a directory tree, for groups with the tree layout"""
+        raise ValueError('This manager doesn\'t support the tree layout.')
+
     @abstractmethod
-    def move_zip(self, zip_path: str):
+    def copy_backup(self, target_dir: str, index: int = 0) -> Optional[str]:
+        """
+            Copy a backup to a directory, 0 being the latest one and rotation_number the oldest.
+            Returns its path, or None if it doesn't exist
+        """
         ...
 
+    def get_tree(self, index: int = 0) -> Optional[str]:
+        """Path of a backup stored as a directory tree, which can be read in place. None if it isn't one"""
+        return None
+
     @abstractmethod
-    def copy_latest_backup(self, target_dir: str):
+    def open_backup(self, index: int = 0) -> Optional[tuple[str, BinaryIO]]:
+        """
+            Open a backup to be read, returning its archive name (eg. backup.zip) and a seekable file,
+            or None if it doesn't exist. Only the parts of it that are read are fetched
+        """
         ...
 
+    def read_manifest(self, index: int = 0) -> Optional[dict]:
+        """Read the manifest of a backup, see archive.read_manifest. None if it doesn't exist"""
+        backup = self.open_backup(index)
+
+        if backup is None:
+            return None
+
+        archive_name, file = backup
+
+        with file:
+            return archive.read_manifest(file, archive_name)
+
+    def extract_backup(self, index: int, target_dir: str, paths: list[str], exclude: set[str]) -> Optional[tuple[dict, set[str]]]:
+        """
+            Extract the files of a backup under some paths, without copying the whole backup.
+            Returns its manifest and the files extracted, or None if it doesn't exist. See archive.extract_members
+        """
+        backup = self.open_backup(index)
+
+        if backup is None:
+            return None
+
+        archive_name, file = backup
+
+        with file:
+            return archive.extract_members(file, archive_name, target_dir, paths, exclude)
+
     @abstractmethod
     def copy_all_backups(self, target_dir: str):
         ...
@@ -0,0 +1,137 @@
+import time
+import random
+import threading
+from typing import Optional
+from googleapiclient.errors import HttpError
+
+RETRY_STATUSES = (429, 500, 502, 503, 504) # Rate limits and server errors
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded') # 403 errors that are rate limits
+
+def get_status(error: HttpError) -> int:
+    return int(error.resp.status)
+
+def is_rate_limit(error: HttpError) -> bool:
+    status = get_status(error)
+
+    return status == 429 or (status == 403 and any( reason in (error.content or b'') for reason in RATE_LIMIT_REASONS ))
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a request failing with an error can succeed if sent again"""
+    if isinstance(error, HttpError):
+        return get_status(error) in RETRY_STATUSES or is_rate_limit(error)
+    else:
+        # Connection errors and timeouts
+        return isinstance(error, OSError)
+
+class TokenBucket:
+    """
+        Limit the rate of requests. The rate is halved each time Drive throttles a request,
+        and raised slowly back while it doesn't, so it stays close to what Drive allows
+    """
+    INITIAL_RATE = 20.0 # Requests per second
+    MIN_RATE = 0.5
+    MAX_RATE = 100.0
+    RATE_INCREASE = 0.5 # Requests per second added after each request that isn't throttled
+
+    def __init__(self):
+        self._rate = self.INITIAL_RATE
+        self._tokens = self.INITIAL_RATE
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get_rate(self):
+        return self._rate
+
+    def acquire(self, tokens=1):
+        """Wait until tokens requests can be made"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+
+                # A burst is at most one second of requests
+                self._tokens = min(max(self._rate, tokens), self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+
+                wait = (tokens - self._tokens) / self._rate
+
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self._rate = min(self.MAX_RATE, self._rate + self.RATE_INCREASE)
+
+    def on_throttled(self):
+        with self._lock:
+            self._rate = max(self.MIN_RATE, self._rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+class DriveExecutor:
+    """
+        Executes every Drive request, shared by all threads.
+        Requests are rate limited by a token bucket, and the ones failing with a temporary
+        error are sent again after an exponential backoff with jitter
+    """
+    MAX_RETRIES = 6
+    BASE_DELAY = 1.0 # Seconds before the first retry, doubled for every following one
+    MAX_DELAY = 64.0
+    GENERATED_IDS = 100 # Ids reserved with each generateIds request
+
+    def __init__(self):
+        self._bucket = TokenBucket()
+        self._ids: list[str] = []
+        self._lock = threading.Lock()
+
+    def get_delay(self, attempt: int) -> float:
+        """Seconds to wait before a retry, full jitter so concurrent retries don't happen at once"""
+        return random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt))
+
+    def acquire(self, requests=1):
+        """Wait until the rate limit allows a number of requests, for the ones not sent through execute"""
+        self._bucket.acquire(requests)
+
+    def report(self, error: Optional[Exception]):
+        """Adapt the rate limit to the result of a request, None if it succeeded"""
+        if error is None:
+            self._bucket.on_success()
+        elif isinstance(error, HttpError) and is_rate_limit(error):
+            self._bucket.on_throttled()
+            print(f'[DRIVE] ...Rate limited, lowering the rate to {self._bucket.get_rate():.1f} requests/s')
+
+    def execute(self, request):
+        """
+            Execute a request, retrying it while it fails with a temporary error.
+            Only for idempotent requests, since a failed attempt may have been applied anyways
+        """
+        return self.call(request.execute)
+
+    def call(self, function):
+        """Call a function making a single request, like execute"""
+        for attempt in range(self.MAX_RETRIES + 1):
+            self._bucket.acquire()
+
+            try:
+                response = function()
+                self.report(None)
+                return response
+            except (HttpError, OSError) as error:
+                self.report(error)
+
+                if not is_retryable(error) or attempt == self.MAX_RETRIES:
+                    raise
+
+                delay = self.get_delay(attempt)
+                print(f'[DRIVE] ...Request failed ({error}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def generate_id(self, service) -> str:
+        """Get an unused file id, so creating a file with it can be retried without creating it twice"""
+        with self._lock:
+            if not self._ids:
+                # pylint: disable=no-member
+                self._ids = self.execute(service.files().generateIds(count=self.GENERATED_IDS, space='drive'))['ids']
+
+            return self._ids.pop()
@@ -0,0 +1,370 @@
+import os
+import json
+import stat
+import time
+import shutil
+import hashlib
+import zipfile
+import tempfile
+from typing import Optional
+from datetime import datetime, timezone
+import archive
+import hashing
+from utils import print_directory_tree
+from .abstract_manager import AbstractManager, MemberSink
+
+# Every byte is mapped to 1 or 0 with a fixed pseudo-random table. A chunk ends after a run of
+# BOUNDARY_RUN ones, which only depends on the last bytes read, so boundaries follow the content
+# and an insertion or deletion only changes the chunks around it
+_BOUNDARY_TABLE = bytes(
+    ord('1') if hashlib.sha256(bytes([byte])).digest()[0] & 1 else ord('0') for byte in range(256)
+)
+
+class CASSnapshot(MemberSink):
+    """
+        Splits every file in content defined chunks and stores them as it's written, like an archive.
+        Each file keeps its own chunks, so a file that hasn't changed is stored as the same chunks no
+        matter what else has changed or how the group is compressed. The snapshot is added once it's committed
+    """
+    def __init__(self, manager: 'ManagerCAS'):
+        super().__init__()
+        self._manager = manager
+        self._manifest = {}
+        self._dirs = []
+        self._files = {}
+        self._chunk_count = 0
+        self._new_bytes = 0
+
+    def _store_chunks(self, buffer: bytearray, chunks: list, eof):
+        for chunk in self._manager.cut_chunks(buffer, eof):
+            digest, is_new = self._manager.store_chunk(chunk)
+            chunks.append([digest, len(chunk)])
+            self._chunk_count += 1
+
+            if is_new:
+                self._new_bytes += len(chunk)
+
+    def _store_file(self, arcname, blocks, stats: Optional[os.stat_result] = None):
+        buffer = bytearray()
+        chunks = []
+
+        for block in blocks:
+            buffer += block
+            self._store_chunks(buffer, chunks, eof=False)
+
+        self._store_chunks(buffer, chunks, eof=True)
+
+        self._files[arcname] = {
+            'size': sum( size for _, size in chunks ),
+            'mode': None if stats is None else stat.S_IMODE(stats.st_mode),
+            'mtime': None if stats is None else stats.st_mtime,
+            'chunks': chunks
+        }
+
+    def write_dir(self, path, arcname):
+        self._dirs.append(arcname)
+
+    def write_data(self, arcname, data: bytes):
+        if arcname == archive.MANIFEST_NAME:
+            self._manifest = json.loads(data)
+        elif arcname == archive.DIGESTS_NAME:
+            # Written after the manifest, and kept in it
+            self._manifest['digests'] = json.loads(data)
+        else:
+            self._store_file(arcname, [data])
+
+    def write_file(self, path, arcname, on_block=None, compress=True):
+        """
+            Add a file
+            - on_block: Called with every block read, to process the file in the same read
+            - compress: Ignored
+        """
+        stats = os.stat(path)
+
+        def blocks():
+            for block in hashing.read_blocks(path):
+                if on_block is not None:
+                    on_block(block)
+
+                yield block
+
+        self._store_file(arcname, blocks(), stats)
+
+    def close(self):
+        ...
+
+    def commit(self):
+        snapshot = {
+            'archive': archive.ZIP_ARCHIVE,
+            'size': sum( entry['size'] for entry in self._files.values() ),
+            'manifest': self._manifest,
+            'dirs': self._dirs,
+            'files': self._files
+        }
+
+        self._manager.write_snapshot(snapshot)
+
+        print(f'[CAS] ...Stored {len(self._files)} files in {self._chunk_count} chunks, {self._new_bytes} of {snapshot["size"]} bytes new')
+
+    def abort(self):
+        # The new chunks aren't referenced by any snapshot
+        if self._new_bytes > 0:
+            self._manager.collect_garbage()
+
+class ManagerCAS(AbstractManager):
+    """
+        Content addressed storage.
+        Files are split in content defined chunks, which are stored once by their hash in
+        an object directory shared by all groups. Each backup is a snapshot listing the chunks of each file,
+        so unchanged data between backups, or between groups, is only stored once.
+    """
+    BACKUP_FOLDER = '/home/alvaro/backups_cas' # Folder where to put the objects and snapshots
+    MIN_CHUNK_SIZE = 256 * 1024
+    MAX_CHUNK_SIZE = 8 * 1024 * 1024
+    BOUNDARY_RUN = 20 # Chunks are MIN_CHUNK_SIZE + 2^BOUNDARY_RUN bytes on average
+
+    def __init__(self, group_name):
+        self._group_name = group_name
+        self._objects_folder = os.path.join(self.BACKUP_FOLDER, 'objects')
+        self._snapshots_root = os.path.join(self.BACKUP_FOLDER, 'snapshots')
+        self._group_backup_folder = os.path.join(self._snapshots_root, group_name)
+
+    def cut_chunks(self, buffer: bytearray, eof: bool):
+        """
+            Cut the content defined chunks at the start of a buffer, removing them from it.
+            Unless eof, it stops while there are less than MAX_CHUNK_SIZE bytes, since they could
+            end in a different boundary once more data is added
+        """
+        boundary = b'1' * self.BOUNDARY_RUN
+
+        while len(buffer) >= self.MAX_CHUNK_SIZE or (eof and buffer):
+            # Find the first run of ones ending after the minimum size
+            start = self.MIN_CHUNK_SIZE - self.BOUNDARY_RUN
+            index = buffer[start:self.MAX_CHUNK_SIZE].translate(_BOUNDARY_TABLE).find(boundary)
+
+            if index != -1:
+                end = start + index + self.BOUNDARY_RUN
+            else:
+                end = min(len(buffer), self.MAX_CHUNK_SIZE)
+
+            yield bytes(buffer[:end])
+            del buffer[:end]
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_folder, digest[:2], digest)
+
+    def store_chunk(self, chunk) -> tuple[str, bool]:
+        """Store a chunk if it isn't already. Returns its hash and whether it was new"""
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._object_path(digest)
+        is_new = not os.path.exists(path)
+
+        if is_new:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # Write to a temporary file first so an interrupted write never leaves a broken object
+            with open(path + '.tmp', 'wb') as file:
+                file.write(chunk)
+
+            os.replace(path + '.tmp', path)
+
+        return digest, is_new
+
+    def _get_snapshots(self, group_folder=None):
+        """Get the snapshot paths of a group, from the latest to the oldest"""
+        group_folder = self._group_backup_folder if group_folder is None else group_folder
+
+        if not os.path.isdir(group_folder):
+            return []
+
+        return [ os.path.join(group_folder, name)
+                for name in sorted(os.listdir(group_folder), reverse=True) if name.endswith('.json') ]
+
+    def _read_snapshot(self, snapshot_path):
+        with open(snapshot_path, 'r', encoding='utf8') as file:
+            return json.load(file)
+
+    def read_chunk(self, digest) -> bytes:
+        """Read a stored chunk, checking it isn't corrupted"""
+        with open(self._object_path(digest), 'rb') as file:
+            chunk = file.read()
+
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise ValueError('Chunk ' + digest + ' is corrupted.')
+
+        return chunk
+
+    def _write_file(self, entry: dict, target):
+        """Write the chunks of a file of a snapshot to a file object"""
+        for digest, _ in entry['chunks']:
+            target.write(self.read_chunk(digest))
+
+    def _restore_snapshot(self, snapshot_path, target):
+        """
+            Rebuild the archive of a snapshot from its chunks, to a path or a file object.
+            The files of a snapshot are rebuilt as a zip without compression
+        """
+        snapshot = self._read_snapshot(snapshot_path)
+
+        with zipfile.ZipFile(target, 'w', zipfile.ZIP_STORED) as zipf:
+            zipf.writestr(zipfile.ZipInfo(archive.MANIFEST_NAME, date_time=(1980, 1, 1, 0, 0, 0)), json.dumps(snapshot['manifest']))
+
+            for arcname in snapshot['dirs']:
+                zipf.writestr(zipfile.ZipInfo(arcname + '/', date_time=(1980, 1, 1, 0, 0, 0)), b'')
+
+            for arcname, entry in snapshot['files'].items():
+                # Zips can't hold dates before 1980
+                date_time = time.localtime(max(entry['mtime'] or 0, 315532800))[:6]
+                zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+
+                if entry['mode'] is not None:
+                    zinfo.external_attr = (stat.S_IFREG | entry['mode']) << 16
+
+                with zipf.open(zinfo, 'w', force_zip64=entry['size'] > zipfile.ZIP64_LIMIT) as member:
+                    self._write_file(entry, member)
+
+    def _get_chunk_digests(self, snapshot: dict):
+        return [ digest for entry in snapshot['files'].values() for digest, _ in entry['chunks'] ]
+
+    def collect_garbage(self):
+        """Remove the chunks not referenced by any snapshot of any group"""
+        referenced = set()
+
+        for group_name in os.listdir(self._snapshots_root):
+            for snapshot_path in self._get_snapshots(os.path.join(self._snapshots_root, group_name)):
+                referenced.update(self._get_chunk_digests(self._read_snapshot(snapshot_path)))
+
+        removed = 0
+
+        for prefix in os.listdir(self._objects_folder):
+            for digest in os.listdir(os.path.join(self._objects_folder, prefix)):
+                if digest not in referenced:
+                    os.remove(os.path.join(self._objects_folder, prefix, digest))
+                    removed += 1
+
+        if removed > 0:
+            print(f'[CAS] ...Removed {removed} unreferenced chunks')
+
+    def create_dir(self):
+        os.makedirs(self._objects_folder, exist_ok=True)
+        os.makedirs(self._group_backup_folder, exist_ok=True)
+
+    def rotate_files(self, rotation_number):
+        expired = self._get_snapshots()[rotation_number + 1:]
+
+        for snapshot_path in expired:
+            os.remove(snapshot_path)
+
+        if expired:
+            self.collect_garbage()
+
+    def open_sink(self, archive_name):
+        # Files are chunked on their own whatever the archive would be, and rebuilt as a zip
+        return CASSnapshot(self)
+
+    def write_snapshot(self, snapshot: dict):
+        """Add a snapshot as the latest backup of the group"""
+        name = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ') + '.json'
+
+        with open(os.path.join(self._group_backup_folder, name + '.tmp'), 'w', encoding='utf8') as file:
+            json.dump(snapshot, file)
+
+        os.replace(os.path.join(self._group_backup_folder, name + '.tmp'), os.path.join(self._group_backup_folder, name))
+
+    def copy_backup(self, target_dir, index=0):
+        snapshots = self._get_snapshots()
+
+        if index < len(snapshots):
+            name = archive.get_backup_name(self._read_snapshot(snapshots[index])['archive'], index)
+            self._restore_snapshot(snapshots[index], os.path.join(target_dir, name))
+            return os.path.join(target_dir, name)
+        else:
+            print(f'[CAS] There is no backup {index} in {self._group_backup_folder}.')
+            return None
+
+    def open_backup(self, index=0):
+        snapshots = self._get_snapshots()
+
+        if index >= len(snapshots):
+            return None
+
+        snapshot = self._read_snapshot(snapshots[index])
+        file = tempfile.TemporaryFile()
+        self._restore_snapshot(snapshots[index], file)
+        file.seek(0)
+
+        return snapshot['archive'], file
+
+    def read_manifest(self, index=0):
+        snapshots = self._get_snapshots()
+
+        return self._read_snapshot(snapshots[index])['manifest'] if index < len(snapshots) else None
+
+    def extract_backup(self, index, target_dir, paths, exclude):
+        snapshots = self._get_snapshots()
+
+        if index >= len(snapshots):
+            return None
+
+        snapshot = self._read_snapshot(snapshots[index])
+
+        # Only the chunks of the files under the paths are read
+        extracted = set()
+
+        for arcname, entry in snapshot['files'].items():
+            if arcname not in archive.METADATA_NAMES and arcname not in exclude and archive.is_under_paths(arcname, paths):
+                target_path = os.path.join(target_dir, arcname)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+                with open(target_path, 'wb') as file:
+                    self._write_file(entry, file)
+
+                if entry['mode'] is not None:
+                    os.chmod(target_path, entry['mode'])
+                if entry['mtime'] is not None:
+                    os.utime(target_path, (entry['mtime'], entry['mtime']))
+
+                extracted.add(arcname)
+
+        return snapshot['manifest'], extracted
+
+    def copy_all_backups(self, target_dir):
+        """Copy all backups for a given group to a directory, named as rotated backups"""
+        for index, snapshot_path in enumerate(self._get_snapshots()):
+            name = archive.get_backup_name(self._read_snapshot(snapshot_path)['archive'], index)
+            self._restore_snapshot(snapshot_path, os.path.join(target_dir, name))
+
+    def clean_backups(self):
+        if os.path.exists(self._group_backup_folder):
+            shutil.rmtree(self._group_backup_folder)
+            self.collect_garbage()
+
+    def list_backups(self):
+        tree_dict = {}
+
+        if os.path.isdir(self._snapshots_root):
+            for group_name in sorted(os.listdir(self._snapshots_root)):
+                snapshots = {}
+
+                for index, snapshot_path in enumerate(self._get_snapshots(os.path.join(self._snapshots_root, group_name))):
+                    snapshot = self._read_snapshot(snapshot_path)
+                    name = archive.get_backup_name(snapshot['archive'], index)
+                    snapshots[name] = { 'id': f'{snapshot["size"]} bytes', 'files': [] }
+
+                tree_dict[group_name] = { 'id': os.path.join(self._snapshots_root, group_name), 'files': snapshots }
+
+        stored_bytes = 0
+        stored_chunks = 0
+
+        if os.path.isdir(self._objects_folder):
+            for prefix in os.listdir(self._objects_folder):
+                for digest in os.listdir(os.path.join(self._objects_folder, prefix)):
+                    stored_bytes += os.path.getsize(os.path.join(self._objects_folder, prefix, digest))
+                    stored_chunks += 1
+
+        print()
+        print('CAS')
+        print_directory_tree(tree_dict)
+        print()
+        print(f'Stored: {stored_chunks} chunks, {stored_bytes} bytes')
+        print()
@@ -1,30 +1,51 @@
-import os
 import io
+import os
+import time
+import hashlib
+import threading
 import tempfile
 from typing import Optional
+import yaml
+import httplib2
+import google_auth_httplib2
 from googleapiclient.discovery import build, Resource
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, HttpRequest
 from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
+import archive
+import hashing
+import transfers
 from utils import print_directory_tree
-from .abstract_manager import AbstractManager
+from .abstract_manager import AbstractManager, ArchiveSink
+from .drive_executor import DriveExecutor, get_status, is_retryable
+from .snapshot_index import SnapshotIndex, INDEX_NAME, new_snapshot_name, new_entry
+
+SECRETS_FILEPATH = os.path.join(os.path.dirname(__file__), '.client_secrets.json')
 
-credentials = service_account.Credentials.from_service_account_file(
-    filename=os.path.join(os.path.dirname(__file__), '.client_secrets.json')
-)
+_credentials = None # Loaded with the service, so they aren't needed until Drive is used
+_service: Optional[Resource] = None # Shared by the whole process, see _get_service
+_service_lock = threading.Lock()
+_local = threading.local() # Holds the HTTP client of each thread
+_executor = DriveExecutor() # Executes every request
 
 CONFIG_FILE_NAME = '.backup_config.yaml'
 CONFIG_FILE_ROTATION = 4
+# Local copy of the remote config, with the metadata of the remote file it was copied from
+CONFIG_CACHE_FILEPATH = os.path.join(os.path.expanduser('~'), '.backup_config_cache.yaml')
+FILE_FIELDS = 'id, name, mimeType, parents, modifiedTime, md5Checksum, size' # Metadata requested for every file
 
 class DriveFile:
-    def __init__(self, file_dict, service):
+    DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024 # Bytes requested at a time when downloading
+
+    def __init__(self, file_dict):
         self.id = file_dict['id']
         self.name = file_dict['name']
         self.mime_type = file_dict['mimeType']
         self.is_dir = 'folder' in self.mime_type
-
-        self._service = service
+        self.parents = file_dict.get('parents', [])
+        self.modified_time = file_dict.get('modifiedTime')
+        self.md5_checksum = file_dict.get('md5Checksum') # Folders don't have one
+        self.size = int(file_dict['size']) if 'size' in file_dict else None
 
     def _log(self, msg):
         ansi_blue = '\033[1;94m'
@@ -33,43 +54,475 @@ class DriveFile:
 
     def delete(self):
         self._log('...Deleting')
-        self._service.files().delete(fileId=self.id).execute()
+        try:
+            _executor.execute(_get_service().files().delete(fileId=self.id))
+        except HttpError as error:
+            # Deleted by an attempt that seemed to fail
+            if get_status(error) != 404:
+                raise
+
+        _cache.remove(self.id)
 
     def change_name(self, new_name):
         self._log(f'...Changing name to {new_name}')
-        self._service.files().update(fileId=self.id, body={'name': new_name}).execute()
+        self.update_metadata(_executor.execute(_get_service().files().update(fileId=self.id, body={'name': new_name}, fields=FILE_FIELDS)))
+
+    def update_metadata(self, file_dict):
+        """Update the metadata after a change. The cache holds this same object, so it's updated in place"""
+        self.name = file_dict.get('name', self.name)
+        self.modified_time = file_dict.get('modifiedTime', self.modified_time)
+        self.md5_checksum = file_dict.get('md5Checksum', self.md5_checksum)
+        self.size = int(file_dict['size']) if 'size' in file_dict else self.size
 
-    def download(self, path):
+    def download(self, path, chunk_size=None):
+        """
+            Download the file in chunks straight to a partial file next to path, which is renamed
+            to path once it's complete. If the partial file exists, the download is resumed from its end.
+            Raises an error if it fails or what is downloaded doesn't match the checksum
+        """
         self._log(f'...Downloading to {path}')
 
+        chunk_size = chunk_size or self.DOWNLOAD_CHUNK_SIZE
+        part_path = path + '.part'
+
         try:
-            request_file = self._service.files().get_media(fileId=self.id)
-            file = io.BytesIO()
-            downloader = MediaIoBaseDownload(file, request_file)
-            done = False
+            if self.size is None:
+                # pylint: disable=no-member
+                self.update_metadata(_executor.execute(_get_service().files().get(fileId=self.id, fields=FILE_FIELDS)))
+
+            # Files without a size, like Google Docs, can't be requested by ranges
+            if self.size is None:
+                with open(part_path, 'wb') as file:
+                    file.write(self.read())
+
+                os.replace(part_path, path)
+                return
+
+            md5_hash = hashlib.md5()
+            offset = 0
+
+            if os.path.exists(part_path):
+                with open(part_path, 'rb') as file:
+                    for block in iter(lambda: file.read(chunk_size), b''):
+                        md5_hash.update(block)
+                        offset += len(block)
 
-            while not done:
-                _, done = downloader.next_chunk()
+                if offset > self.size:
+                    offset = 0
+                    md5_hash = hashlib.md5()
+                elif offset > 0:
+                    self._log(f'...Resuming from byte {offset}')
 
-            with open(path, 'wb') as f:
-                f.write(file.getvalue())
+            resumed = offset > 0
+
+            with open(part_path, 'ab' if offset > 0 else 'wb') as file:
+                while offset < self.size:
+                    chunk = self.read_range(offset, min(chunk_size, self.size - offset))
+
+                    if not chunk:
+                        break
+
+                    file.write(chunk)
+                    md5_hash.update(chunk)
+                    offset += len(chunk)
+
+            if offset < self.size:
+                # The partial file is kept, so the next download resumes it
+                raise ValueError(f'Download of {self.name} ended at byte {offset} of {self.size}.')
+
+            if self.md5_checksum is not None and md5_hash.hexdigest() != self.md5_checksum:
+                os.remove(part_path)
+
+                # The partial file may be from a previous version of the file, so start over
+                if resumed:
+                    self._log('...Partial download doesn\'t match, restarting it')
+                    self.download(path, chunk_size)
+                else:
+                    raise ValueError('Download of ' + self.name + ' is corrupted, the checksum doesn\'t match.')
+            else:
+                os.replace(part_path, path)
         except HttpError as error:
-            print(F'An error occurred: {error}')
+            print(f'[DRIVE] An error occurred downloading {self.name}: {error}')
+            raise
+
+    def read(self) -> bytes:
+        """Download a small file into memory"""
+        # pylint: disable=no-member
+        return _executor.execute(_get_service().files().get_media(fileId=self.id))
+
+    def read_range(self, offset, length) -> bytes:
+        """Download length bytes from an offset, with an HTTP Range request"""
+        # pylint: disable=no-member
+        request = _get_service().files().get_media(fileId=self.id)
+        request.headers['Range'] = f'bytes={offset}-{offset + length - 1}'
+
+        return _executor.execute(request)
 
     def get_folder_files(self):
         """Get files in the case it's a directory"""
         if not self.is_dir:
             raise ValueError('DriveFile ' + self.name + ' is not a directory.')
         else:
-            return [ DriveFile(file, self._service)
-                    for file in self._service.files().list(q=f"'{self.id}' in parents").execute()['files'] ]
+            return _cache.get_folder_files(self.id)
+
+class DriveReader(io.RawIOBase):
+    """
+        Seekable file reading a Drive file with Range requests, so only the parts that are read are downloaded.
+        Meant to be wrapped in a BufferedReader, so small reads are served from a single request
+    """
+    BUFFER_SIZE = 4 * 1024 * 1024 # Bytes requested at least by each read through the BufferedReader
+
+    def __init__(self, file: DriveFile):
+        super().__init__()
+        self._file = file
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = { io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._file.size }[whence]
+        self._position = max(0, base + offset)
+
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._file.size - self._position)
+
+        if length <= 0:
+            return 0
+
+        data = self._file.read_range(self._position, length)
+        buffer[:len(data)] = data
+        self._position += len(data)
+
+        return len(data)
+
+class DriveCache:
+    """
+        Metadata of the Drive file tree, shared by every manager during a run.
+        Each folder is listed once, and the files created, renamed or deleted
+        afterwards are applied to the cached listings instead of listing them again.
+        It's used from the transfer threads too, so every access holds a lock
+    """
+    MAX_PAGE_SIZE = 1000 # Maximum number of files per page allowed by Drive
+    MAX_QUERY_PARENTS = 50 # Folders listed by each query, keeping it under the maximum query length
+
+    def __init__(self):
+        self._files: dict[str, DriveFile] = {}
+        self._folders: dict[str, list[str]] = {} # Folder id -> ids of its files, only for listed folders
+        self._lock = threading.RLock()
+
+    def _list_files(self, query) -> list[DriveFile]:
+        """List every file matching a query, following the pages of the response"""
+        files = []
+        page_token = None
+
+        while True:
+            # pylint: disable=no-member
+            response = _executor.execute(_get_service().files().list(
+                q=query,
+                fields=f'nextPageToken, files({FILE_FIELDS})',
+                pageSize=self.MAX_PAGE_SIZE,
+                pageToken=page_token
+            ))
+
+            files += [ DriveFile(file) for file in response['files'] ]
+            page_token = response.get('nextPageToken')
+
+            if page_token is None:
+                return files
+
+    def list_folders(self, folder_ids: list[str]):
+        """List the folders that aren't cached, several of them with each query"""
+        with self._lock:
+            folder_ids = [ folder_id for folder_id in dict.fromkeys(folder_ids) if folder_id not in self._folders ]
+
+            # The parents of the files in the root have its actual id instead of 'root', so it's listed on its own
+            if 'root' in folder_ids:
+                folder_ids.remove('root')
+                files = self._list_files("'root' in parents")
+
+                self._files.update( (file.id, file) for file in files )
+                self._folders['root'] = [ file.id for file in files ]
+
+            for start in range(0, len(folder_ids), self.MAX_QUERY_PARENTS):
+                query_ids = folder_ids[start:start + self.MAX_QUERY_PARENTS]
+                files = self._list_files(' or '.join( f"'{folder_id}' in parents" for folder_id in query_ids ))
+
+                for folder_id in query_ids:
+                    self._folders[folder_id] = []
+
+                for file in files:
+                    self._files[file.id] = file
+
+                    for parent_id in file.parents:
+                        if parent_id in query_ids:
+                            self._folders[parent_id].append(file.id)
+
+    def list_tree(self, folder_id):
+        """List a folder and every folder under it, a whole level of the tree at a time"""
+        level = [folder_id]
+
+        while level:
+            self.list_folders(level)
+            level = [ file.id for folder_id in level for file in self.get_folder_files(folder_id) if file.is_dir ]
+
+    def get_folder_files(self, folder_id) -> list[DriveFile]:
+        """Get the files in a folder, listing it if it isn't cached. 'root' is the root folder"""
+        with self._lock:
+            self.list_folders([folder_id])
+
+            return [ self._files[file_id] for file_id in self._folders[folder_id] ]
+
+    def add(self, folder_id, file: DriveFile):
+        """Add a file created in a folder"""
+        with self._lock:
+            self._files[file.id] = file
+
+            if folder_id in self._folders:
+                self._folders[folder_id].append(file.id)
+
+            # A new folder is known to be empty
+            if file.is_dir:
+                self._folders[file.id] = []
+
+    def remove(self, file_id):
+        """Remove a deleted file, and everything inside it if it's a folder"""
+        with self._lock:
+            self._files.pop(file_id, None)
+
+            for file_ids in self._folders.values():
+                if file_id in file_ids:
+                    file_ids.remove(file_id)
+
+            for child_id in self._folders.pop(file_id, []):
+                self.remove(child_id)
+
+    def invalidate(self, folder_id=None):
+        """Forget the listing of a folder, or of every folder if None, after a change that couldn't be tracked"""
+        with self._lock:
+            if folder_id is None:
+                self._folders.clear()
+            else:
+                self._folders.pop(folder_id, None)
+
+_cache = DriveCache()
+
+class DriveBatch:
+    """
+        Changes to several files, sent together through the batch endpoint in a single request.
+        The ones that fail with a temporary error are sent again in another batch
+    """
+    MAX_BATCH_SIZE = 100 # Maximum number of requests in a batch allowed by Drive
+
+    def __init__(self):
+        self._items = [] # (File, function building the request, function called on success)
+
+    def delete(self, file: DriveFile):
+        file._log('...Deleting')
+        self._items.append((
+            file,
+            lambda: _get_service().files().delete(fileId=file.id),
+            lambda _: _cache.remove(file.id)
+        ))
+
+    def change_name(self, file: DriveFile, new_name):
+        file._log(f'...Changing name to {new_name}')
+        self._items.append((
+            file,
+            lambda: _get_service().files().update(fileId=file.id, body={'name': new_name}, fields=FILE_FIELDS),
+            lambda file_dict: file.update_metadata(file_dict)
+        ))
+
+    def _execute_batch(self, items) -> list[tuple[tuple, Exception]]:
+        """Send a batch, returning the failed items with their errors"""
+        failed = []
+        answered = set()
+
+        def callback(request_id, response, exception):
+            item = items[int(request_id)]
+            file, _, on_success = item
+
+            answered.add(int(request_id))
+            _executor.report(exception)
+
+            if exception is None:
+                on_success(response)
+            elif isinstance(exception, HttpError) and get_status(exception) == 404:
+                # Deleted by someone else, or by an attempt that seemed to fail
+                _cache.remove(file.id)
+            else:
+                failed.append((item, exception))
+
+        batch = _get_service().new_batch_http_request(callback=callback)
+
+        for n, (_, build_request, _) in enumerate(items):
+            batch.add(build_request(), request_id=str(n))
+
+        # Every request in a batch counts against the rate limit
+        _executor.acquire(len(items))
+
+        try:
+            batch.execute()
+        except (HttpError, OSError) as error:
+            if not is_retryable(error):
+                raise
+
+            failed += [ (item, error) for n, item in enumerate(items) if n not in answered ]
+
+        return failed
+
+    def execute(self):
+        """Send every change. Raises the first error of the ones that failed, once every other one has been sent"""
+        items, self._items = self._items, []
+        errors = []
+
+        for attempt in range(_executor.MAX_RETRIES + 1):
+            failed = []
+
+            for start in range(0, len(items), self.MAX_BATCH_SIZE):
+                failed += self._execute_batch(items[start:start + self.MAX_BATCH_SIZE])
+
+            # Renames and deletions can be sent again safely. The rest have failed for good
+            items = [ item for item, error in failed if is_retryable(error) ]
+            errors += [ error for _, error in failed if not is_retryable(error) ]
+
+            if not items:
+                break
+            elif attempt == _executor.MAX_RETRIES:
+                errors += [ error for _, error in failed if is_retryable(error) ]
+                break
+
+            delay = _executor.get_delay(attempt)
+            print(f'[DRIVE] ...Retrying {len(items)} failed requests in {delay:.1f}s')
+            time.sleep(delay)
+
+        if errors:
+            # The failed changes may have been applied anyways
+            _cache.invalidate()
+            raise errors[0]
+
+class UploadSessions:
+    """
+        Resumable upload sessions in progress, saved to a file after every chunk so an upload
+        interrupted by a crash or a lost connection is resumed by the next run
+    """
+    FILEPATH = os.path.join(os.path.expanduser('~'), '.backup_uploads.yaml')
+    SESSION_LIFETIME = 7 * 24 * 3600 # Seconds Drive keeps an upload session
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        """Load the sessions, removing the ones that have expired or whose file doesn't exist anymore"""
+        if not os.path.exists(self.FILEPATH):
+            return {}
+
+        with open(self.FILEPATH, 'r', encoding='utf8') as file:
+            sessions = yaml.safe_load(file) or {}
+
+        live = { key: session for key, session in sessions.items()
+                 if time.time() - session.get('time', 0) < self.SESSION_LIFETIME and os.path.exists(session.get('path', '')) }
+
+        if len(live) != len(sessions):
+            self._save(live)
+
+        return live
+
+    def _save(self, sessions: dict):
+        with open(self.FILEPATH + '.tmp', 'w', encoding='utf8') as file:
+            yaml.safe_dump(sessions, file)
+
+        os.replace(self.FILEPATH + '.tmp', self.FILEPATH)
+
+    def get(self, key) -> Optional[dict]:
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key, session: Optional[dict]):
+        """Save the session of an upload, or remove it if None"""
+        with self._lock:
+            sessions = self._load()
+
+            if session is not None:
+                sessions[key] = session
+            elif key in sessions:
+                del sessions[key]
+            else:
+                return
+
+            self._save(sessions)
+
+_sessions = UploadSessions()
+
+class DriveSink(ArchiveSink):
+    """
+        Spools the archive to a local file, which is only uploaded once it's committed. So nothing is sent for
+        a backup discarded as unchanged, and an interrupted upload is resumed by the next run, see _send_upload.
+        The spool of an interrupted upload is kept until a new archive is written, which is replaced by it
+        if they are the same, so its upload is resumed
+    """
+    def __init__(self, manager: 'ManagerDrive', spool_dir, archive_name):
+        super().__init__()
+        os.makedirs(spool_dir, exist_ok=True)
+        self._manager = manager
+        self._spool_dir = spool_dir
+        self._archive_name = archive_name
+        self._path = os.path.join(spool_dir, new_snapshot_name(archive_name))
+        self._file = open(self._path + '.partial', 'wb')
+        self._md5 = hashlib.md5()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._md5.update(data)
+
+    def close(self):
+        self._file.close()
+        os.replace(self._path + '.partial', self._path)
+
+        digest = self._md5.hexdigest()
+        leftovers = [ os.path.join(self._spool_dir, name) for name in os.listdir(self._spool_dir) if name != os.path.basename(self._path) ]
+        # Only complete spools are uploaded, the partial ones were never closed
+        reused = next((path for path in leftovers if not path.endswith('.partial')
+                       and os.path.getsize(path) == self.tell() and _get_file_md5(path) == digest), None)
+
+        for path in leftovers:
+            if path != reused:
+                os.remove(path)
+
+        if reused is not None:
+            print(f'[DRIVE] ...{os.path.basename(reused)} has the same contents, resuming its upload')
+            os.remove(self._path)
+            self._path = reused
+
+    def commit(self):
+        self._manager.upload_snapshot(self._path, self._archive_name, self._md5.hexdigest())
+        os.remove(self._path)
+
+    def abort(self):
+        self._file.close()
+
+        for path in (self._path + '.partial', self._path):
+            if os.path.exists(path):
+                os.remove(path)
 
 class ManagerDrive(AbstractManager):
+    CONCURRENT_TRANSFERS = True
     CONFIG_FILE_NAME = '.backup_config.yaml'
+    SPOOL_FOLDER = os.path.join(os.path.expanduser('~'), '.backup_spool') # Backups waiting to be uploaded, see DriveSink
+    UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024 # Bytes sent at a time when uploading, a multiple of 256 KB
 
     def __init__(self, name):
         self._group_backup_folder = name
-        self._service = _build_service()
+        self._index: Optional[SnapshotIndex] = None # Read the first time it's needed
+        self._index_file: Optional[DriveFile] = None
 
     def _bytes_to_readable_amount(self, byte_n: int):
         """Convert a number of bytes to a readable string"""
@@ -86,7 +539,7 @@ class ManagerDrive(AbstractManager):
 
     def _print_storage_quotas(self):
         # pylint: disable=no-member
-        quotas = self._service.about().get(fields="storageQuota").execute()
+        quotas = _executor.execute(_get_service().about().get(fields="storageQuota"))
         used_bytes = int(quotas['storageQuota']['usage'])
 
         print()
@@ -94,10 +547,8 @@ class ManagerDrive(AbstractManager):
         print('Left:', self._bytes_to_readable_amount(int(quotas['storageQuota']['limit']) - used_bytes))
 
     def _get_root_files(self):
-        # pylint: disable=no-member
         """Get the files in the root folder"""
-        return [ DriveFile(file, self._service)
-                for file in self._service.files().list(q="parents = 'root'").execute()['files'] ]
+        return _cache.get_folder_files('root')
 
     def _get_files_in_dir_by_name(self, folder_name):
         """Get the files from the first dir in the root with a given name"""
@@ -118,15 +569,17 @@ class ManagerDrive(AbstractManager):
 
         return None
 
-    def _upload_file(self, filepath, dir_name, filename):
+    def _upload_file(self, filepath, dir_name, filename) -> DriveFile:
         """
-            Upload a file
+            Upload a file, returning it
             - filepath: File path of the file to upload
             - dir_name: Parent directory in drive. If None, it uploads it to the root
             - filename: Filename the file is to be uploaded as
         """
         print(f'[DRIVE] ...Uploading {filepath} to {dir_name}/{filename}')
 
+        dir_id = 'root'
+
         try:
             file_metadata = {'name': filename}
 
@@ -138,20 +591,65 @@ class ManagerDrive(AbstractManager):
                 else:
                     raise ValueError('Could not upload backup. Directory ' + dir_name + ' doesn\'t exist.')
 
-            media = MediaFileUpload(filepath, resumable=True)
+            file = DriveFile(self._send_upload(file_metadata, filepath))
+            _cache.add(dir_id, file)
 
-            # pylint: disable=no-member
-            self._service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
+            return file
         except HttpError as err:
             print(f"[DRIVE] An error occurred: {err}")
+            # The upload may have been completed anyways
+            _cache.invalidate(dir_id)
+            # Retrying didn't help, so the backup is lost if it isn't reported
+            raise
+
+    def _send_upload(self, file_metadata: dict, filepath) -> dict:
+        """
+            Upload a file in chunks, saving the session after each one. If the upload is interrupted,
+            uploading the same file, unmodified, to the same folder with the same name resumes it.
+            Like _create_file, the id is generated beforehand. Returns the metadata of the file
+        """
+        stats = os.stat(filepath)
+        size = stats.st_size
+        # The file is the same one as long as its stats are, so it doesn't have to be read to find its session
+        key = f"{file_metadata.get('parents', ['root'])[0]}/{file_metadata['name']}/{size}/{stats.st_mtime_ns}"
+        session = _sessions.get(key)
+        started = time.time() if session is None else session['time']
+        file_metadata = {**file_metadata, 'id': _executor.generate_id(_get_service()) if session is None else session['id']}
+
+        media = MediaFileUpload(filepath, chunksize=self.UPLOAD_CHUNK_SIZE, resumable=True)
+        # pylint: disable=no-member
+        request = _get_service().files().create(body=file_metadata, media_body=media, fields=FILE_FIELDS)
+        file_dict = None
+
+        if session is not None:
+            offset = _executor.call(lambda: _query_upload_offset(request.http, session['uri'], size))
+
+            if offset is None:
+                print(f'[DRIVE] ...Upload session of {filepath} expired, starting over')
+            elif offset == size:
+                # It was completed, but not saved as such
+                file_dict = _executor.execute(_get_service().files().get(fileId=file_metadata['id'], fields=FILE_FIELDS))
+            else:
+                print(f'[DRIVE] ...Resuming upload of {filepath} from byte {offset} of {size}')
+                request.resumable_uri = session['uri']
+                request.resumable_progress = offset
+
+        if file_dict is None:
+            file_dict = _run_upload(request, file_metadata['id'], on_chunk=lambda: _sessions.set(key, {
+                'id': file_metadata['id'],
+                'uri': request.resumable_uri,
+                'offset': request.resumable_progress,
+                'path': os.path.abspath(filepath),
+                'time': started
+            }))
+
+        _sessions.set(key, None)
+
+        return file_dict
 
     def _change_file_name(self, file_id, new_name):
         # pylint: disable=no-member
-        self._service.files().update(fileId=file_id, body={'name': new_name}).execute()
+        _executor.execute(_get_service().files().update(fileId=file_id, body={'name': new_name}))
 
     def create_dir(self):
         # Folder doesn't exist
@@ -163,39 +661,97 @@ class ManagerDrive(AbstractManager):
             }
 
             try:
-                # pylint: disable=no-member
-                self._service.files().create(body=file_metadata, fields="id").execute()
+                file_dict = _create_file(file_metadata)
+                _cache.add('root', DriveFile(file_dict))
             except HttpError as error:
                 print(f"An error occurred: {error}")
+                _cache.invalidate('root')
+
+    def _get_index(self) -> SnapshotIndex:
+        """Get the index of the group. If there isn't one, it's built from the backups rotated by renaming them"""
+        if self._index is None:
+            files = self._get_files_in_dir_by_name(self._group_backup_folder) or []
+            self._index_file = _find_file_with_name(files, INDEX_NAME)
+
+            if self._index_file is not None:
+                self._index = SnapshotIndex.from_json(self._index_file.read().decode('utf8'))
+            else:
+                files_by_name = { file.name: file for file in files }
+                self._index = SnapshotIndex.from_legacy_names(list(files_by_name), lambda name: {
+                    'size': files_by_name[name].size,
+                    'digest': files_by_name[name].md5_checksum,
+                    'id': files_by_name[name].id
+                })
+
+        return self._index
+
+    def _write_index(self):
+        media = MediaIoBaseUpload(io.BytesIO(self._get_index().to_json().encode('utf8')), mimetype='application/json')
+
+        if self._index_file is not None:
+            # pylint: disable=no-member
+            self._index_file.update_metadata(_executor.execute(
+                _get_service().files().update(fileId=self._index_file.id, media_body=media, fields=FILE_FIELDS)
+            ))
+        else:
+            dir_id = self._get_directory_id(self._group_backup_folder)
+            self._index_file = DriveFile(_create_file({ 'name': INDEX_NAME, 'parents': [dir_id] }, media))
+            _cache.add(dir_id, self._index_file)
+
+    def add_snapshot(self, entry: dict):
+        """Add a backup uploaded to the group folder as the latest one"""
+        self._get_index().add(entry)
+        self._write_index()
 
     def rotate_files(self, rotation_number):
-        base_backup_file = 'backup.zip'
-        files = self._get_files_in_dir_by_name(self._group_backup_folder)
+        removed = self._get_index().prune(rotation_number)
 
-        # Remove backup.zip.4
-        file = _find_file_with_name(files, f'{base_backup_file}.4')
-        if file is not None:
-            file.delete()
+        # The index is written first, so it never has a backup that doesn't exist
+        if removed:
+            self._write_index()
 
-        # backup.zip.1 -> backup.zip.2...
-        for n in range(rotation_number):
-            m = rotation_number - n
-            file = _find_file_with_name(files, f'{base_backup_file}.{m-1}')
-            if file is not None:
-                file.change_name(f'{base_backup_file}.{m}')
+        batch = DriveBatch()
 
-        # backup.zip -> backup.zip.1
-        file = _find_file_with_name(files, base_backup_file)
-        if file is not None:
-            file.change_name(f'{base_backup_file}.1')
+        for entry in removed:
+            batch.delete(_entry_to_file(entry))
+
+        batch.execute()
+
+    def open_sink(self, archive_name):
+        return DriveSink(self, os.path.join(self.SPOOL_FOLDER, self._group_backup_folder), archive_name)
+
+    def upload_snapshot(self, filepath, archive_name, digest):
+        """Upload a backup, named as its file, and add it as the latest one. See DriveSink"""
+        name = os.path.basename(filepath)
+        dir_id = self._get_directory_id(self._group_backup_folder)
+
+        if dir_id is None:
+            raise ValueError('Could not upload backup. Directory ' + self._group_backup_folder + ' doesn\'t exist.')
+
+        # Files that aren't in the index were left by an interrupted backup, unless it's the one being resumed
+        indexed = { entry['id'] for entry in self._get_index().get_entries() }
+        batch = DriveBatch()
 
-    def move_zip(self, zip_path):
-        self._upload_file(zip_path, self._group_backup_folder, 'backup.zip')
+        for file in _cache.get_folder_files(dir_id):
+            if file.id not in indexed and file.name not in (INDEX_NAME, name):
+                batch.delete(file)
+
+        batch.execute()
+
+        file = self._upload_file(filepath, self._group_backup_folder, name)
+
+        if file.md5_checksum is not None and file.md5_checksum != digest:
+            file.delete()
+            raise ValueError(f'Checksum of the uploaded {name} doesn\'t match: {file.md5_checksum} != {digest}')
+
+        self.add_snapshot(new_entry(name, archive_name, file.size, file.md5_checksum, id=file.id))
 
     def list_backups(self, files=None, indent=0):
         tree_dict = {}
 
         if files is None:
+            # Everything is listed beforehand, so the recursion below doesn't make any request
+            _cache.list_tree('root')
             files = self._get_root_files()
 
         for file in files:
@@ -219,28 +775,143 @@ class ManagerDrive(AbstractManager):
         for file in self._get_root_files():
             if file.is_dir and file.name == self._group_backup_folder:
                 file.delete()
+                self._index = None
+                self._index_file = None
 
-    def copy_latest_backup(self, target_dir):
-        files = self._get_files_in_dir_by_name(self._group_backup_folder)
+    def copy_backup(self, target_dir, index=0):
+        entry = self._get_index().get(index)
 
-        if files:
-            file = [ file for file in files if file.name == 'backup.zip' ][0]
-            file.download(os.path.join(target_dir, 'backup.zip'))
-        else:
-            raise ValueError(self._group_backup_folder + ' does not have any backups.')
+        if entry is None:
+            print(f'[DRIVE] {self._group_backup_folder} does not have backup {index}.')
+            return None
 
-    def copy_all_backups(self, target_dir):
-        """Copy all backups for a given group to a directory"""
-        files = self._get_files_in_dir_by_name(self._group_backup_folder)
+        target_path = os.path.join(target_dir, archive.get_backup_name(entry['archive'], index))
+        _entry_to_file(entry).download(target_path)
 
-        if files is None:
+        return target_path
+
+    def open_backup(self, index=0):
+        entry = self._get_index().get(index)
+
+        if entry is None:
+            return None
+
+        print(f'[DRIVE] ...Reading {self._group_backup_folder}/{entry["name"]}')
+
+        return entry['archive'], io.BufferedReader(DriveReader(_entry_to_file(entry)), DriveReader.BUFFER_SIZE)
+
+    def copy_all_backups(self, target_dir):
+        """Copy all backups for a given group to a directory, named as rotated backups"""
+        if self._get_directory_id(self._group_backup_folder) is None:
             print(f'[DRIVE] ...File group {self._group_backup_folder} doesn\'t exist.')
         else:
-            for file in files:
-                file.download(os.path.join(target_dir, file.name))
+            # Downloaded in the background, see transfers.wait
+            for index, entry in enumerate(self._get_index().get_entries()):
+                name = archive.get_backup_name(entry['archive'], index)
+                transfers.submit(f'{self._group_backup_folder}/{name}', _entry_to_file(entry).download, os.path.join(target_dir, name))
+
+def _entry_to_file(entry: dict) -> DriveFile:
+    """File of a backup in the index, without requesting its metadata"""
+    return DriveFile({
+        'id': entry['id'],
+        'name': entry['name'],
+        'mimeType': 'application/octet-stream',
+        'md5Checksum': entry['digest'],
+        'size': entry['size']
+    })
+
+def _get_http() -> google_auth_httplib2.AuthorizedHttp:
+    """Get the HTTP client of the current thread, which keeps its connections open between requests"""
+    if getattr(_local, 'http', None) is None:
+        _local.http = google_auth_httplib2.AuthorizedHttp(_credentials, http=httplib2.Http())
+
+    return _local.http
+
+def _build_request(_http, *args, **kwargs) -> HttpRequest:
+    # HTTP clients can't be shared between threads, so each request is sent through the one of its thread
+    return HttpRequest(_get_http(), *args, **kwargs)
 
 def _build_service() -> Resource:
-    return build('drive', 'v3', credentials=credentials)
+    return build('drive', 'v3', credentials=_credentials, requestBuilder=_build_request)
+
+def _get_service() -> Resource:
+    """
+        Get the service shared by the whole process, building it the first time.
+        It can be used from any thread, see _build_request
+    """
+    global _service, _credentials
+
+    with _service_lock:
+        if _service is None:
+            _credentials = service_account.Credentials.from_service_account_file(filename=SECRETS_FILEPATH)
+            _service = _build_service()
+
+        return _service
+
+def _create_file(file_metadata: dict, media_body=None) -> dict:
+    """
+        Create a file with an id generated beforehand, so it can be retried without creating it twice.
+        If an attempt that seemed to fail did create it, the following ones fail with a conflict
+        - media_body: Contents of the file, if they are small enough to be sent in a single request
+    """
+    file_metadata = {**file_metadata, 'id': _executor.generate_id(_get_service())}
+
+    try:
+        # pylint: disable=no-member
+        return _executor.execute(_get_service().files().create(body=file_metadata, media_body=media_body, fields=FILE_FIELDS))
+    except HttpError as error:
+        if get_status(error) != 409:
+            raise
+
+        return _executor.execute(_get_service().files().get(fileId=file_metadata['id'], fields=FILE_FIELDS))
+
+def _run_upload(request: HttpRequest, file_id, on_chunk=None) -> dict:
+    """
+        Send the chunks of a resumable upload until it's completed, returning the metadata of the file.
+        Like _create_file, the id of the file has to be generated beforehand
+        - on_chunk: Called after every chunk but the last one
+    """
+    file_dict = None
+
+    try:
+        while file_dict is None:
+            # After an error, the next chunk asks for the offset Drive has received before sending anything
+            _, file_dict = _executor.call(request.next_chunk)
+
+            if file_dict is None and on_chunk is not None:
+                on_chunk()
+    except HttpError as error:
+        # An attempt that seemed to fail did complete it
+        if get_status(error) != 409:
+            raise
+
+        # pylint: disable=no-member
+        file_dict = _executor.execute(_get_service().files().get(fileId=file_id, fields=FILE_FIELDS))
+
+    return file_dict
+
+def _query_upload_offset(http, session_uri, size) -> Optional[int]:
+    """Ask how many bytes of an upload session Drive has received. None if the session has expired"""
+    response, content = http.request(session_uri, 'PUT', headers={'Content-Length': '0', 'Content-Range': f'bytes */{size}'})
+
+    if response.status == 308:
+        # Range: bytes=0-<last byte received>, missing if none has been received
+        return int(response['range'].split('-')[1]) + 1 if 'range' in response else 0
+    elif response.status in (200, 201):
+        return size
+    elif response.status in (404, 410):
+        return None
+    else:
+        raise HttpError(response, content, uri=session_uri)
+
+def _get_file_md5(filepath) -> str:
+    """MD5 of the contents of a file, as Drive reports it"""
+    _hash = hashlib.md5()
+
+    for block in hashing.read_blocks(filepath):
+        _hash.update(block)
+
+    return _hash.hexdigest()
 
 def _find_file_with_name(files: list[DriveFile], name: str) -> Optional[DriveFile]:
     for file in files:
@@ -250,13 +921,11 @@ def _find_file_with_name(files: list[DriveFile], name: str) -> Optional[DriveFil
     return None
 
 def get_remote_file(file_id, target_dir):
-    service = _build_service()
-
     # Get file metadata
     # pylint: disable=no-member
-    file_dict = service.files().get(fileId=file_id).execute()
+    file_dict = _executor.execute(_get_service().files().get(fileId=file_id, fields=FILE_FIELDS))
 
-    file = DriveFile(file_dict, service)
+    file = DriveFile(file_dict)
     file.download(os.path.join(target_dir, file_dict['name']))
 
 def upload_remote_file(filepath):
@@ -264,49 +933,100 @@ def upload_remote_file(filepath):
     manager._upload_file(filepath, None, os.path.basename(filepath))
 
 def delete_remote_file(file_id):
-    service = _build_service()
-    file = DriveFile({'id': file_id, 'name': '', 'mimeType': ''}, service)
+    file = DriveFile({'id': file_id, 'name': '', 'mimeType': ''})
     file.delete()
 
+def _read_config_cache() -> Optional[dict]:
+    if not os.path.isfile(CONFIG_CACHE_FILEPATH):
+        return None
+
+    with open(CONFIG_CACHE_FILEPATH, 'r', encoding='utf8') as file:
+        return yaml.safe_load(file)
+
+def _write_config_cache(file: DriveFile, contents: str):
+    """Save the contents of the remote config, checked just now"""
+    cache = {
+        'md5Checksum': file.md5_checksum,
+        'modifiedTime': file.modified_time,
+        'checked': time.time(),
+        'contents': contents
+    }
+
+    with open(CONFIG_CACHE_FILEPATH + '.tmp', 'w', encoding='utf8') as f:
+        yaml.safe_dump(cache, f)
+
+    os.replace(CONFIG_CACHE_FILEPATH + '.tmp', CONFIG_CACHE_FILEPATH)
+
+def _get_config_ttl(contents: str) -> int:
+    """Get the remote_config_ttl of a config, without parsing its groups"""
+    for line in contents.splitlines():
+        if line.startswith('remote_config_ttl:'):
+            return int(yaml.safe_load(line)['remote_config_ttl'])
+
+    return 0
+
 def get_config_file_contents():
-    temp_dir = tempfile.TemporaryDirectory()
+    """
+        Get the contents of the remote config. A local copy is kept, which is only downloaded again
+        if the metadata of the remote file shows it has changed. For the remote_config_ttl seconds
+        of the local copy after checking the metadata, the local copy is used without checking it
+    """
+    cache = _read_config_cache()
+
+    if cache is not None and time.time() - cache['checked'] < _get_config_ttl(cache['contents']):
+        return cache['contents']
+
     manager = ManagerDrive('noname')
-    files = manager._get_root_files()
+    file = _find_file_with_name(manager._get_root_files(), CONFIG_FILE_NAME)
+
+    if file is None:
+        print("[DRIVE] Couldn't read remote config file.")
+        return None
 
-    if any([ file.name == CONFIG_FILE_NAME for file in files ]):
+    if cache is not None and cache['md5Checksum'] == file.md5_checksum and cache['modifiedTime'] == file.modified_time:
+        contents = cache['contents']
+    else:
+        temp_dir = tempfile.TemporaryDirectory()
         temp_path = os.path.join(temp_dir.name, CONFIG_FILE_NAME)
-        file = [ file for file in files if file.name == CONFIG_FILE_NAME ][0]
         file.download(temp_path)
 
         with open(temp_path, 'r', encoding='utf8') as f:
-            return f.read()
-    else:
-        print("[DRIVE] Couldn't read remote config file.")
-        return None
+            contents = f.read()
+
+    _write_config_cache(file, contents)
+
+    return contents
 
 def update_config_file(filepath):
     manager = ManagerDrive('noname')
     files = manager._get_root_files()
+    batch = DriveBatch()
 
     # Rotate config files
 
     # Remove .backup_config.yaml.4
     file = _find_file_with_name(files, f'{CONFIG_FILE_NAME}.4')
     if file is not None:
-        file.delete()
+        batch.delete(file)
 
     # .backup_config.yaml.1 -> .backup_config.yaml.2...
     for n in range(CONFIG_FILE_ROTATION):
         m = CONFIG_FILE_ROTATION - n
         file = _find_file_with_name(files, f'{CONFIG_FILE_NAME}.{m-1}')
         if file is not None:
-            file.change_name(f'{CONFIG_FILE_NAME}.{m}')
+            batch.change_name(file, f'{CONFIG_FILE_NAME}.{m}')
 
     # .backup_config.yaml.zip -> .backup_config.yaml.1
     file = _find_file_with_name(files, CONFIG_FILE_NAME)
     if file is not None:
-        file.change_name(f'{CONFIG_FILE_NAME}.1')
+        batch.change_name(file, f'{CONFIG_FILE_NAME}.1')
+
+    batch.execute()
 
     # Upload file
-    manager._upload_file(filepath, None, CONFIG_FILE_NAME)
+    file = manager._upload_file(filepath, None, CONFIG_FILE_NAME)
+
+    # The next load doesn't have to download what has just been uploaded
+    with open(filepath, 'r', encoding='utf8') as f:
+        _write_config_cache(file, f.read())
 
@@ -1,46 +1,318 @@
 import os
+import json
+import stat
 import shutil
-import pathlib
-from .abstract_manager import AbstractManager
+import hashlib
+from typing import Optional
+import archive
+import hashing
+import copying
+from .abstract_manager import AbstractManager, ArchiveSink, MemberSink
+from .snapshot_index import SnapshotIndex, INDEX_NAME, new_snapshot_name, new_entry
+
+PARTIAL_SUFFIX = '.partial' # Added to the name of a backup while it's written
+TREE_NAME = 'backup.tree' # Archive name of the backups with the tree layout
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+class LocalSink(ArchiveSink):
+    """Writes the archive next to its destination, and renames it and adds it to the index once it's committed"""
+    def __init__(self, manager: 'ManagerLocal', archive_name):
+        super().__init__()
+        self._manager = manager
+        self._archive_name = archive_name
+        self._name = new_snapshot_name(archive_name)
+        self._path = os.path.join(manager.get_group_folder(), self._name)
+        self._md5 = hashlib.md5()
+        self._file = open(self._path + PARTIAL_SUFFIX, 'wb')
+
+    def _write(self, data):
+        self._file.write(data)
+        self._md5.update(data)
+
+    def close(self):
+        self._file.close()
+
+    def commit(self):
+        os.replace(self._path + PARTIAL_SUFFIX, self._path)
+        self._manager.add_snapshot(new_entry(self._name, self._archive_name, self.tell(), self._md5.hexdigest()))
+
+    def abort(self):
+        self._file.close()
+
+        if os.path.exists(self._path + PARTIAL_SUFFIX):
+            os.remove(self._path + PARTIAL_SUFFIX)
+
+class TreeSnapshot(MemberSink):
+    """
+        Backup stored as a copy of the files, like rsync --link-dest.
+        Files whose digest is the same as in the previous tree are hardlinked to it instead of copied,
+        so only the changed ones take space. Since they are shared between backups, they are read only
+    """
+    def __init__(self, manager: 'ManagerLocal', files: list, previous_path: Optional[str]):
+        super().__init__()
+        self._manager = manager
+        self._files = files
+        self._name = new_snapshot_name(TREE_NAME)
+        self._path = os.path.join(manager.get_group_folder(), self._name + PARTIAL_SUFFIX)
+        self._previous_path = previous_path
+        self._previous_digests = {} if previous_path is None else archive.read_manifest(previous_path).get('digests', {})
+        self._digests = self._get_digests() # Pending files don't have one until they are hashed
+        self._manifest = {}
+        self._written: list[str] = []
+        self._linked = 0
+        self._copied_bytes = 0
+
+        os.makedirs(self._path)
+
+    def _get_digests(self) -> dict[str, Optional[str]]:
+        digests = {}
+
+        for file in self._files:
+            if file.exists():
+                digests.update(file.get_scanned_digests())
+
+        return digests
+
+    def write_dir(self, path, arcname):
+        os.makedirs(os.path.join(self._path, arcname), exist_ok=True)
+
+    def write_data(self, arcname, data: bytes):
+        if arcname == archive.MANIFEST_NAME:
+            # Written once it's committed, with the digest of every file
+            self._manifest = json.loads(data)
+        elif arcname == archive.DIGESTS_NAME:
+            self._manifest['digests'] = json.loads(data)
+        else:
+            with open(os.path.join(self._path, arcname), 'wb') as file:
+                file.write(data)
+
+    def write_file(self, path, arcname, on_block=None, compress=True):
+        """
+            Add a file, linking it to the previous tree if it hasn't changed
+            - on_block: Called with every block read, if it's copied
+            - compress: Ignored
+        """
+        target = os.path.join(self._path, arcname)
+        digest = self._digests.get(arcname)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        self._written.append(arcname)
+
+        if digest is not None and digest == self._previous_digests.get(arcname) and self._link_previous(arcname, target):
+            self._linked += 1
+            return
+
+        if digest is not None:
+            # It doesn't have to be hashed, so it's copied without reading it
+            copying.copy_file(path, target)
+            self._copied_bytes += os.path.getsize(target)
+        else:
+            with open(target, 'wb') as file:
+                for block in hashing.read_blocks(path):
+                    file.write(block)
+                    self._copied_bytes += len(block)
+
+                    if on_block is not None:
+                        on_block(block)
+
+            shutil.copystat(path, target)
+
+        os.chmod(target, os.stat(target).st_mode & ~WRITE_BITS)
+
+    def _link_previous(self, arcname, target) -> bool:
+        """Hardlink a file to the previous tree. False if it can't, eg. it's missing or it has too many links"""
+        try:
+            os.link(os.path.join(self._previous_path, arcname), target)
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        ...
+
+    def commit(self):
+        manifest = json.dumps(self._manifest).encode('utf8')
+
+        with open(os.path.join(self._path, archive.MANIFEST_NAME), 'wb') as file:
+            file.write(manifest)
+
+        os.replace(self._path, os.path.join(self._manager.get_group_folder(), self._name))
+        # The size of a tree is what it takes on top of the previous one
+        self._manager.add_snapshot(new_entry(self._name, TREE_NAME, self._copied_bytes, hashlib.md5(manifest).hexdigest()))
+
+        print(f'[LOCAL] ...Linked {self._linked} unchanged files, copied {len(self._written) - self._linked} ({self._copied_bytes} bytes)')
+
+    def abort(self):
+        shutil.rmtree(self._path, ignore_errors=True)
 
 class ManagerLocal(AbstractManager):
     BACKUP_FOLDER = '/home/alvaro/backups' # Folder where to put the backups
+    SUPPORTS_TREES = True
 
     def __init__(self, group_name):
         self._group_name = group_name
         self._group_backup_folder = os.path.join(self.BACKUP_FOLDER, group_name)
+        self._index: Optional[SnapshotIndex] = None # Read the first time it's needed
+
+    def get_group_folder(self):
+        return self._group_backup_folder
 
     def create_dir(self):
         os.makedirs(self._group_backup_folder, exist_ok=True)
 
+    def _describe_legacy_backup(self, name) -> dict:
+        # Not hashed, the index is rebuilt by every command until the next backup writes it
+        return { 'size': os.path.getsize(os.path.join(self._group_backup_folder, name)), 'digest': None }
+
+    def _get_index(self) -> SnapshotIndex:
+        """Get the index of the group. If there isn't one, it's built from the backups rotated by renaming them"""
+        if self._index is None:
+            index_path = os.path.join(self._group_backup_folder, INDEX_NAME)
+
+            if os.path.isfile(index_path):
+                with open(index_path, 'r', encoding='utf8') as file:
+                    self._index = SnapshotIndex.from_json(file.read())
+            elif os.path.isdir(self._group_backup_folder):
+                self._index = SnapshotIndex.from_legacy_names(os.listdir(self._group_backup_folder), self._describe_legacy_backup)
+            else:
+                self._index = SnapshotIndex()
+
+        return self._index
+
+    def _write_index(self):
+        index_path = os.path.join(self._group_backup_folder, INDEX_NAME)
+
+        with open(index_path + '.tmp', 'w', encoding='utf8') as file:
+            file.write(self._get_index().to_json())
+
+        os.replace(index_path + '.tmp', index_path)
+
+    def add_snapshot(self, entry: dict):
+        """Add a backup written to the group folder as the latest one"""
+        self._get_index().add(entry)
+        self._write_index()
+
     def rotate_files(self, rotation_number):
-        base_backup_file = os.path.join(self._group_backup_folder, 'backup.zip') # folder/backup.zip
+        removed = self._get_index().prune(rotation_number)
+
+        # The index is written first, so it never has a backup that doesn't exist
+        if removed:
+            self._write_index()
+
+        for entry in removed:
+            self._remove_backup(entry['name'])
+
+    def _remove_backup(self, name):
+        path = os.path.join(self._group_backup_folder, name)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
-        for n in range(rotation_number):
-            m = rotation_number - n
-            if os.path.exists(f'{base_backup_file}.{m-1}'):
-                # backup.zip.1 -> backup.zip.2...
-                shutil.move(f'{base_backup_file}.{m-1}', f'{base_backup_file}.{m}')
+    def _remove_partial_backups(self):
+        """Remove the backups left by an interrupted save"""
+        for name in os.listdir(self._group_backup_folder):
+            if name.endswith(PARTIAL_SUFFIX):
+                self._remove_backup(name)
 
-        # backup.zip -> backup.zip.1
-        if os.path.exists(base_backup_file):
-            shutil.move(f'{base_backup_file}', f'{base_backup_file}.1')
+    def open_sink(self, archive_name):
+        self._remove_partial_backups()
 
-    def move_zip(self, zip_path):
-        shutil.move(zip_path, os.path.join(self._group_backup_folder, 'backup.zip'))
+        return LocalSink(self, archive_name)
 
-    def copy_latest_backup(self, target_dir):
-        zip_path = os.path.join(self._group_backup_folder, 'backup.zip')
+    def open_tree_snapshot(self, files):
+        self._remove_partial_backups()
 
-        if os.path.exists(zip_path):
-            shutil.copy(zip_path, target_dir)
+        # The latest tree, which may not be the latest backup if the layout has changed
+        previous = next(( entry for entry in self._get_index().get_entries() if entry['archive'] == TREE_NAME ), None)
+
+        return TreeSnapshot(self, files, None if previous is None else os.path.join(self._group_backup_folder, previous['name']))
+
+    def copy_backup(self, target_dir, index=0):
+        entry = self._get_index().get(index)
+
+        if entry is None:
+            print(f'[LOCAL] There is no backup {index} in {self._group_backup_folder}.')
+            return None
+
+        source_path = os.path.join(self._group_backup_folder, entry['name'])
+        target_path = os.path.join(target_dir, archive.get_backup_name(entry['archive'], index))
+
+        if os.path.isdir(source_path):
+            # Copied rather than linked, so the files of the backup can't be changed through the copy.
+            # It's built next to the target and swapped in, replacing a previous copy whole
+            partial_path = target_path + PARTIAL_SUFFIX
+            shutil.rmtree(partial_path, ignore_errors=True)
+            method = copying.describe(copying.copy_tree(source_path, partial_path, copy_function=copying.copy_writable))
+
+            if os.path.isdir(target_path):
+                shutil.rmtree(target_path)
+
+            os.replace(partial_path, target_path)
         else:
-            print('[LOCAL] There are no backups in ' + self._group_backup_folder + '.')
+            method = copying.copy_file(source_path, target_path)
+
+        print(f'[LOCAL] ...Copied {entry["name"]} to {target_path} ({method})')
+
+        return target_path
+
+    def get_tree(self, index=0):
+        entry = self._get_index().get(index)
+
+        if entry is None or entry['archive'] != TREE_NAME:
+            return None
+
+        return os.path.join(self._group_backup_folder, entry['name'])
+
+    def open_backup(self, index=0):
+        entry = self._get_index().get(index)
+
+        if entry is None:
+            return None
+        elif entry['archive'] == TREE_NAME:
+            raise ValueError('Backup ' + entry['name'] + ' is a tree, not an archive.')
+
+        return entry['archive'], open(os.path.join(self._group_backup_folder, entry['name']), 'rb')
+
+    def read_manifest(self, index=0):
+        entry = self._get_index().get(index)
+
+        if entry is None:
+            return None
+
+        return archive.read_manifest(os.path.join(self._group_backup_folder, entry['name']), entry['archive'])
+
+    def extract_backup(self, index, target_dir, paths, exclude):
+        entry = self._get_index().get(index)
+
+        if entry is None or entry['archive'] != TREE_NAME:
+            return super().extract_backup(index, target_dir, paths, exclude)
+
+        # The files of a tree are copied straight from it
+        tree_path = os.path.join(self._group_backup_folder, entry['name'])
+        extracted = set()
+
+        for path in paths:
+            source_path = os.path.join(tree_path, path)
+
+            if os.path.isdir(source_path):
+                relpaths = [ os.path.relpath(os.path.join(root, f), tree_path) for root, _, file_list in os.walk(source_path) for f in file_list ]
+            else:
+                relpaths = [path] if os.path.isfile(source_path) else []
+
+            for relpath in relpaths:
+                if relpath not in archive.METADATA_NAMES and relpath not in exclude and relpath not in extracted:
+                    target_path = os.path.join(target_dir, relpath)
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    copying.copy_writable(os.path.join(tree_path, relpath), target_path)
+                    extracted.add(relpath)
+
+        return archive.read_manifest(tree_path), extracted
 
     def copy_all_backups(self, target_dir):
-        """Copy all backups for a given group to a directory"""
-        for file in pathlib.Path(self._group_backup_folder).iterdir():
-            shutil.copy(str(file.absolute()), target_dir)
+        """Copy all backups for a given group to a directory, named as rotated backups"""
+        for index in range(len(self._get_index())):
+            self.copy_backup(target_dir, index)
 
     def clean_backups(self):
         # Being a bit paranoid
@@ -48,6 +320,7 @@ class ManagerLocal(AbstractManager):
         and 'backups' in self._group_backup_folder\
         and os.path.exists(self._group_backup_folder):
             shutil.rmtree(self._group_backup_folder)
+            self._index = None
 
     def list_backups(self):
         os.system('tree ' + self.BACKUP_FOLDER)
@@ -0,0 +1,70 @@
+import json
+from datetime import datetime, timezone
+from typing import Optional
+import archive
+
+INDEX_NAME = 'index.json' # Stored in the folder of each group
+
+class SnapshotIndex:
+    """
+        Backups of a group, from the latest to the oldest.
+        Each backup is stored under a name that never changes, so adding one or pruning the oldest
+        one doesn't touch the others. Every entry has the name the backup is stored as, the archive
+        it is (eg. backup.zip), when it was made, its size and its MD5 digest, if it's known. Managers may add more
+    """
+    def __init__(self, entries: Optional[list[dict]] = None):
+        self._entries = [] if entries is None else entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_entries(self) -> list[dict]:
+        return self._entries
+
+    def get(self, index: int) -> Optional[dict]:
+        """Get a backup, 0 being the latest one. None if there isn't one"""
+        return self._entries[index] if 0 <= index < len(self._entries) else None
+
+    def add(self, entry: dict):
+        """Add a backup as the latest one"""
+        self._entries.insert(0, entry)
+
+    def prune(self, rotation_number: int) -> list[dict]:
+        """Remove the backups older than the latest one and rotation_number more, returning them"""
+        removed = self._entries[rotation_number + 1:]
+        del self._entries[rotation_number + 1:]
+
+        return removed
+
+    def to_json(self) -> str:
+        return json.dumps({ 'backups': self._entries }, indent=1)
+
+    @classmethod
+    def from_json(cls, contents: str):
+        return cls(json.loads(contents)['backups'])
+
+    @classmethod
+    def from_legacy_names(cls, names: list[str], describe) -> 'SnapshotIndex':
+        """
+            Build the index of backups rotated by renaming them, eg. backup.zip, backup.zip.1...
+            They keep their names, which new backups don't use. When they were made isn't known
+            - describe: Called with the name of each backup, returns a dict with its size, digest and any other field
+        """
+        backups = [ (name, archive.parse_backup_name(name)) for name in names ]
+        backups = sorted([ (name, backup) for name, backup in backups if backup is not None ], key=lambda backup: backup[1][1])
+
+        return cls([ { **new_entry(name, archive_name, **describe(name)), 'time': None } for name, (archive_name, _) in backups ])
+
+def new_snapshot_name(archive_name: str) -> str:
+    """Name to store a new backup as, eg. backup.zip.20240131T120000000000Z"""
+    return f'{archive_name}.{datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")}'
+
+def new_entry(name: str, archive_name: str, size: int, digest: Optional[str], **extra) -> dict:
+    return {
+        'name': name,
+        'archive': archive_name,
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'size': size,
+        'digest': digest,
+        **extra
+    }
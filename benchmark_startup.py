@@ -0,0 +1,48 @@
+"""
+    Startup time benchmark of the command line.
+    Each run is a fresh interpreter, with a temporary home holding a config for a local setup.
+    Usage: python benchmark_startup.py [runs]
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import statistics
+
+# Modules loaded by every command, and whether the Google client was loaded with them
+IMPORT_CODE = 'import sys, config, backup_manager; print("googleapiclient" in sys.modules)'
+LOCAL_CONFIG = 'time: 0\nrotation_number: 4\nmanager_type: LOCAL\ngroups: []\n'
+TARGET_MS = 100 # Time local commands should start in
+
+def time_command(args: list[str], env: dict, runs: int) -> tuple[float, str]:
+    """Run a command several times, returning the median time in milliseconds and the output of the last run"""
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(args, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        times.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(times), output
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as home:
+        with open(os.path.join(home, '.backup_config.yaml'), 'w', encoding='utf8') as file:
+            file.write(LOCAL_CONFIG)
+
+        env = { **os.environ, 'HOME': home }
+
+        baseline, _ = time_command([sys.executable, '-c', 'pass'], env, runs)
+        imports, output = time_command([sys.executable, '-c', IMPORT_CODE], env, runs)
+        command, _ = time_command([sys.executable, 'backup.py', 'config'], env, runs)
+
+    print(f'Interpreter:          {baseline:.1f} ms')
+    print(f'Imports:              {imports:.1f} ms (Google client imported: {output.strip()})')
+    print(f'backup.py config:     {command:.1f} ms ({"under" if command < TARGET_MS else "over"} the {TARGET_MS} ms target)')
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,19 @@
 import os
 import time
-from pathlib import Path
 import tempfile
 from datetime import datetime
+from typing import Optional
 import yaml
 from filegroup import FileGroup
 from file import Filetype
-from backup_manager import ManagerType
-from backup_managers.manager_drive import get_config_file_contents, update_config_file
+from backup_manager import ManagerType, load_drive
 
 class Config:
     DEFAULT_FILEPATH = os.path.join(os.path.expanduser('~'), '.backup_config.yaml')
     DEFAULT_ROTATION_NUMBER = 4
     DEFAULT_MANAGER_TYPE = ManagerType('LOCAL')
     TRY_TO_FETCH_REMOTE_CONFIG = True
+    DEFAULT_REMOTE_CONFIG_TTL = 0 # Seconds in which the local copy of the remote config is used without checking it has changed
 
     def __init__(self, epoch=0):
         self.time = int(time.time()) if epoch == 0 else epoch
@@ -21,6 +21,8 @@ class Config:
         self.rotation_number = self.DEFAULT_ROTATION_NUMBER
         self.groups: list[FileGroup] = []
         self.manager_type: ManagerType = self.DEFAULT_MANAGER_TYPE
+        # Read from the local copy of the remote config before loading it, see manager_drive.get_config_file_contents
+        self.remote_config_ttl = self.DEFAULT_REMOTE_CONFIG_TTL
 
     def __str__(self):
         return yaml.dump(self._to_dict(), Dumper=yaml.Dumper, sort_keys=False)
@@ -98,21 +100,38 @@ class Config:
 
         self.groups.remove(self.find_group_with_name(name))
 
+    def _get_local_manager_type(self) -> Optional[ManagerType]:
+        """Get the manager type of the local config file, without parsing its groups"""
+        try:
+            with open(self.DEFAULT_FILEPATH, 'r', encoding='utf8') as f:
+                for line in f:
+                    if line.startswith('manager_type:'):
+                        return ManagerType(yaml.safe_load(line)['manager_type'])
+        except Exception:
+            ...
+
+        return None
+
     def load(self):
-        """Load config from remote, and a file if it fails"""
+        """
+            Load config from remote, and a file if it fails
+            Local and CAS configs are only saved to the file, so remote isn't tried for them
+        """
         config_yaml = None
+        try_remote = self.TRY_TO_FETCH_REMOTE_CONFIG and self._get_local_manager_type() in (None, ManagerType.DRIVE)
 
-        if self.TRY_TO_FETCH_REMOTE_CONFIG:
+        if try_remote:
             try:
-                config_yaml = get_config_file_contents()
+                config_yaml = load_drive().get_config_file_contents()
             except Exception:
                 ...
 
         # If the config doesn't exist on remote, attempt to load it on local
         if config_yaml is None:
-            print('...Failed to load remote config. Attempting local')
+            if try_remote:
+                print('...Failed to load remote config. Attempting local')
 
-            if Path(self.DEFAULT_FILEPATH).is_file():
+            if os.path.isfile(self.DEFAULT_FILEPATH):
                 try:
                     with open(self.DEFAULT_FILEPATH, 'r', encoding='utf8') as f:
                         config_yaml = f.read()
@@ -129,6 +148,7 @@ class Config:
             self.rotation_number = config['rotation_number']
             self.manager_type = ManagerType(config['manager_type'])
             self.groups = self._parse_groups(config['groups'], self.manager_type)
+            self.remote_config_ttl = config.get('remote_config_ttl', self.DEFAULT_REMOTE_CONFIG_TTL)
         else:
             print('...Failed to load remote and local config. Creating new one')
 
@@ -144,10 +164,9 @@ class Config:
 
     def save(self):
         """Save config to a file, local or remote"""
-        config_dict = self._to_dict(int(time.time()))
-        config_yaml = yaml.dump(config_dict, Dumper=yaml.Dumper)
+        config_yaml = yaml.dump(self._to_dict(int(time.time())), Dumper=yaml.Dumper)
 
-        if self.manager_type == ManagerType.LOCAL:
+        if self.manager_type in (ManagerType.LOCAL, ManagerType.CAS):
             with open(self.DEFAULT_FILEPATH, 'w', encoding='utf8') as file:
                 file.write(config_yaml)
         elif self.manager_type == ManagerType.DRIVE:
@@ -157,12 +176,13 @@ class Config:
             with open(tmpfile, 'w', encoding='utf8') as file:
                 file.write(config_yaml)
 
-            update_config_file(tmpfile)
+            load_drive().update_config_file(tmpfile)
 
     def _to_dict(self, _time=None):
         return {
             'time': self.time if _time is None else _time,
             'rotation_number': self.rotation_number,
             'manager_type': self.manager_type.value,
+            'remote_config_ttl': self.remote_config_ttl,
             'groups': [ group.to_dict() for group in self.groups ]
         }
@@ -0,0 +1,164 @@
+import os
+import stat
+import errno
+import shutil
+import threading
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+# Ways of copying a file, from the fastest. See copy_file
+REFLINK = 'reflink' # The copy shares the blocks of the source until either is modified. btrfs, XFS...
+COPY_FILE_RANGE = 'copy_file_range' # Copied by the kernel, or by the filesystem on the server for NFS and SMB
+SENDFILE = 'sendfile' # Copied by the kernel
+BUFFER = 'buffer' # Read and written through a buffer
+METHODS = [REFLINK, COPY_FILE_RANGE, SENDFILE, BUFFER]
+
+FICLONE = 0x40049409 # ioctl of linux/fs.h
+KERNEL_CHUNK_SIZE = 1024 * 1024 * 1024 # Bytes copied by each copy_file_range or sendfile call
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# Errors meaning a method isn't supported between two files, rather than the copy failing
+_UNSUPPORTED_ERRNOS = { errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF, errno.EPERM }
+# (method, source device, target device) that have failed, so they aren't tried again
+_unsupported: set[tuple[str, int, int]] = set()
+_lock = threading.Lock()
+
+def _reflink(source_fd, target_fd, _):
+    fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+def _copy_file_range(source_fd, target_fd, size):
+    copied = 0
+
+    while copied < size:
+        n = os.copy_file_range(source_fd, target_fd, KERNEL_CHUNK_SIZE)
+
+        # Some filesystems, eg. procfs, copy nothing instead of failing
+        if n == 0 and copied == 0:
+            raise OSError(errno.EOPNOTSUPP, 'copy_file_range copied nothing')
+        elif n == 0:
+            break
+
+        copied += n
+
+def _sendfile(source_fd, target_fd, size):
+    offset = 0
+
+    while offset < size:
+        n = os.sendfile(target_fd, source_fd, offset, KERNEL_CHUNK_SIZE)
+
+        if n == 0 and offset == 0:
+            raise OSError(errno.EOPNOTSUPP, 'sendfile copied nothing')
+        elif n == 0:
+            break
+
+        offset += n
+
+def _buffer_copy(source_fd, target_fd, _):
+    while True:
+        data = os.read(source_fd, BUFFER_SIZE)
+
+        if not data:
+            break
+
+        view = memoryview(data)
+
+        while view:
+            view = view[os.write(target_fd, view):]
+
+_FUNCTIONS = {
+    REFLINK: _reflink,
+    COPY_FILE_RANGE: _copy_file_range,
+    SENDFILE: _sendfile,
+    BUFFER: _buffer_copy
+}
+
+def _is_available(method) -> bool:
+    if method == REFLINK:
+        return fcntl is not None and hasattr(fcntl, 'ioctl')
+    elif method == COPY_FILE_RANGE:
+        return hasattr(os, 'copy_file_range')
+    elif method == SENDFILE:
+        return hasattr(os, 'sendfile')
+    else:
+        return True
+
+def copy_file(source, target) -> str:
+    """
+        Copy a file with its permissions and times, like shutil.copy2, trying the fastest way first.
+        Returns the one that was used, see METHODS
+    """
+    # Checked before opening them, since opening the target truncates it and opening a pipe blocks
+    if os.path.exists(target) and os.path.samefile(source, target):
+        raise shutil.SameFileError(f'{source} and {target} are the same file')
+
+    for path in (source, target):
+        if os.path.exists(path) and not stat.S_ISREG(os.stat(path).st_mode):
+            raise shutil.SpecialFileError(f'{path} is not a regular file')
+
+    with open(source, 'rb', buffering=0) as source_file, open(target, 'wb', buffering=0) as target_file:
+        source_fd, target_fd = source_file.fileno(), target_file.fileno()
+        size = os.fstat(source_fd).st_size
+        devices = (os.fstat(source_fd).st_dev, os.fstat(target_fd).st_dev)
+
+        for method in METHODS:
+            if not _is_available(method) or (method, *devices) in _unsupported:
+                continue
+
+            try:
+                _FUNCTIONS[method](source_fd, target_fd, size)
+                break
+            except OSError as error:
+                if method == BUFFER or error.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+
+                with _lock:
+                    _unsupported.add((method, *devices))
+
+                # Start over with the next one, in case it copied part of it
+                os.lseek(source_fd, 0, os.SEEK_SET)
+                os.lseek(target_fd, 0, os.SEEK_SET)
+                os.ftruncate(target_fd, 0)
+
+        copied = os.fstat(target_fd).st_size
+
+        if copied < size:
+            raise ValueError(f'Couldn\'t copy {source}: Only {copied} of {size} bytes were copied with {method}.')
+
+    shutil.copystat(source, target)
+
+    return method
+
+def copy_writable(source, target) -> str:
+    """Copy a file with copy_file, letting its owner write to the copy, eg. of a read only file of a tree backup"""
+    method = copy_file(source, target)
+    os.chmod(target, os.stat(target).st_mode | stat.S_IWUSR)
+
+    return method
+
+def copy_tree(source, target, copy_function=None) -> Counter:
+    """
+        Copy a directory like shutil.copytree, with copy_file.
+        Returns how many files were copied with each method
+        - copy_function: Called to copy each file instead of copy_file, returning the method it used
+    """
+    methods = Counter()
+    copy_function = copy_file if copy_function is None else copy_function
+
+    def _copy(src, dst):
+        methods[copy_function(src, dst)] += 1
+
+    shutil.copytree(source, target, copy_function=_copy)
+
+    return methods
+
+def move(source, target):
+    """Move a file or directory like shutil.move, copying it with copy_file if it's on another filesystem"""
+    shutil.move(source, target, copy_function=copy_file)
+
+def describe(methods: Counter) -> str:
+    """Describe the methods used to copy several files, eg. reflink: 3, buffer: 1"""
+    return ', '.join( f'{method}: {count}' for method, count in methods.most_common() ) or 'no files'
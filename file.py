@@ -1,7 +1,11 @@
 import os
+import time
 from enum import Enum
+from typing import Optional
 import hashlib
-import shutil
+import hashing
+import archive
+import copying
 
 class Filetype(Enum):
     """
@@ -12,11 +16,18 @@ class Filetype(Enum):
     FILETYPE_SYMLINK = 'SYMLINK'
 
 class File:
-    def __init__(self, filepath: str, basepath: str, filetype=Filetype.FILETYPE_FILE, digest=None):
+    # Files modified this recently may still be changing within the timestamp
+    # granularity, so their stats aren't trusted on the next digest
+    RACY_WINDOW_NS = 2 * 10**9
+
+    def __init__(self, filepath: str, basepath: str, filetype=Filetype.FILETYPE_FILE, digest=None, cache=None):
         self._filetype = filetype
         self._relpath = os.path.relpath(filepath, basepath) # Path relative to the basepath
         self._basepath = basepath
         self._filepath = filepath
+        # Stats and digest of every file, keyed by path relative to the basepath
+        self._cache: dict[str, dict] = {} if cache is None else cache
+        self._scan_cache = self._cache # Cache being built by the last scan
         self._md5 = self.digest().decode() if digest is None else digest
 
     def get_filepath(self): return self._filepath
@@ -24,56 +35,143 @@ class File:
     def get_filetype(self): return self._filetype
     def get_digest(self): return self._md5
 
-    def digest(self):
-        """Calculate the MD5 digest of the file"""
+    def digest(self, paranoid=False):
+        """
+            Calculate the MD5 digest of the file
+            Files whose stats haven't changed since the last call reuse their cached
+            digest, unless paranoid is set
+        """
+        pending = self.scan(paranoid)
+
+        return self._apply_scan(hashing.digest_files(pending))
+
+    def update_digest(self, paranoid=False):
+        self._md5 = self.digest(paranoid).decode()
+
+    def update_digest_from_scan(self, digests: dict[str, bytes]):
+        """Update the digest from the last scan, given the digests of the paths it returned"""
+        self._md5 = self._apply_scan(digests).decode()
+
+    def get_scanned_digests(self) -> dict[str, Optional[str]]:
+        """Get the digests found by the last scan, keyed by path relative to the basepath. Pending ones are None"""
+        return { key: entry['md5'] for key, entry in self._scan_cache.items() }
+
+    def scan(self, paranoid=False) -> list[str]:
+        """
+            Walk the file collecting the stats of everything under it, without reading any contents.
+            Returns the paths whose digest isn't cached and has to be calculated
+        """
+        pending = []
+        self._scan_cache = {}
+
         if self._filetype == Filetype.FILETYPE_DIR:
-            return self._dir_digest(self._filepath)
+            self._scan_tree = self._scan_dir(self._filepath, pending, paranoid)
         else:
-            return self._file_digest(self._filepath)
+            self._scan_tree = self._scan_file(self._filepath, os.stat(self._filepath), pending, paranoid)
 
-    def _dir_digest(self, dirpath):
-        """Calculate the MD5 digest of the directory"""
-        # Add the directory name to enforce hash changes on directory name change
-        md5_hash = hashlib.md5(os.path.basename(dirpath).encode('utf-8'))
+        return pending
 
-        for entry in sorted(os.listdir(dirpath)):
-            path = os.path.join(dirpath, entry)
+    def _scan_dir(self, dirpath, pending, paranoid):
+        with os.scandir(dirpath) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
 
-            if os.path.isdir(path):
-                md5_hash.update( self._dir_digest(path) )
+        children = []
+
+        for entry in entries:
+            if entry.is_dir():
+                children.append( self._scan_dir(entry.path, pending, paranoid) )
             else:
-                md5_hash.update( self._file_digest(path) )
+                children.append( self._scan_file(entry.path, entry.stat(), pending, paranoid) )
+
+        return (Filetype.FILETYPE_DIR, os.path.basename(dirpath), children)
+
+    def _scan_file(self, filepath, stat: os.stat_result, pending, paranoid):
+        """Reuse the cached digest of a file if its stats haven't changed, marking it as pending otherwise"""
+        key = os.path.relpath(filepath, self._basepath)
+        entry = self._cache.get(key)
+        stats = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+            'ctime_ns': stat.st_ctime_ns
+        }
+
+        unchanged = not paranoid and entry is not None and all(entry.get(k) == v for k, v in stats.items())
+
+        if unchanged:
+            digest = entry['md5']
+        else:
+            digest = None
+            pending.append(filepath)
+
+        if time.time_ns() - max(stat.st_mtime_ns, stat.st_ctime_ns) < self.RACY_WINDOW_NS:
+            stats = {}
+
+        self._scan_cache[key] = { **stats, 'md5': digest }
+
+        if unchanged and 'compressible' in entry:
+            self._scan_cache[key]['compressible'] = entry['compressible']
 
-        return md5_hash.hexdigest().encode('utf-8')
+        return (Filetype.FILETYPE_FILE, filepath, key)
 
-    def _file_digest(self, filepath):
-        """Calculate the MD5 digest of the file"""
-        # Add the file name to enforce hash changes on file name change
-        _hash = hashlib.md5(os.path.basename(filepath).encode('utf-8'))
+    def _apply_scan(self, digests: dict[str, bytes]) -> bytes:
+        digest = self._combine_digests(self._scan_tree, digests)
 
-        with open(filepath, 'rb') as file:
-            _hash.update(file.read())
+        # Entries of files that no longer exist are dropped
+        self._cache = self._scan_cache
 
-        return _hash.hexdigest().encode('utf8')
+        return digest
 
-    def update_digest(self):
-        self._md5 = self.digest().decode()
+    def _combine_digests(self, node, digests: dict[str, bytes]) -> bytes:
+        """Calculate the digest of a scanned node, in the same order regardless of how the files were hashed"""
+        if node[0] == Filetype.FILETYPE_DIR:
+            _, dirname, children = node
+            # Add the directory name to enforce hash changes on directory name change
+            md5_hash = hashlib.md5(dirname.encode('utf-8'))
+
+            for child in children:
+                md5_hash.update( self._combine_digests(child, digests) )
+
+            return md5_hash.hexdigest().encode('utf-8')
+        else:
+            _, filepath, key = node
+            entry = self._scan_cache[key]
+
+            if entry['md5'] is None:
+                entry['md5'] = digests[filepath].decode('utf8')
+
+            return entry['md5'].encode('utf8')
+
+    def is_compressible(self, filepath):
+        """Check if a file under this one is worth compressing, caching the answer with its digest"""
+        # Files are archived between a scan and its digests being applied, so the entries of the scan are used
+        entry = self._scan_cache.get(os.path.relpath(filepath, self._basepath))
+
+        if entry is None:
+            return archive.is_compressible(filepath)
+        elif 'compressible' not in entry:
+            entry['compressible'] = archive.is_compressible(filepath)
+
+        return entry['compressible']
 
     def exists(self):
         """Check if file exists"""
         return os.path.exists(self._filepath)
 
-    def copy_to_dir(self, dirpath):
-        """Copy file to a directory"""
+    def copy_to_dir(self, dirpath) -> str:
+        """Copy file to a directory. Returns how it was copied, see copying.METHODS"""
+        target = os.path.join(dirpath, os.path.basename(self._filepath))
+
         if self._filetype == Filetype.FILETYPE_DIR:
-            shutil.copytree(self._filepath, os.path.join(dirpath, os.path.basename(self._filepath)))
+            return copying.describe(copying.copy_tree(self._filepath, target))
         else:
-            shutil.copy(self._filepath, dirpath)
+            return copying.copy_file(self._filepath, target)
 
     def to_dict(self):
         """Serialize file"""
         return {
             'relpath': self._relpath,
             'filetype': self._filetype.value,
-            'md5': self._md5
+            'md5': self._md5,
+            'cache': self._cache
         }
@@ -1,11 +1,23 @@
 import os
 import hashlib
 from typing import Optional
+import archive
 from file import File, Filetype
 from backup_manager import BackupManager, ManagerType
 
 class FileGroup:
-    def __init__(self, name='unnamed_group', basepath='', digest = None, manager_type: Optional[ManagerType] = None):
+    # full: every backup has all the files
+    # incremental: only the files changed since the last backup
+    # differential: only the files changed since the last full backup
+    BACKUP_MODES = ['full', 'incremental', 'differential']
+    # archive: every backup is an archive, see archive.py
+    # tree: every backup is a copy of the files, sharing the unchanged ones with the previous backup. Local only
+    LAYOUTS = ['archive', 'tree']
+    DEFAULT_FULL_EVERY = 7 # Backups between full ones in incremental and differential modes
+
+    def __init__(self, name='unnamed_group', basepath='', digest = None, manager_type: Optional[ManagerType] = None,
+                 compression=archive.DEFAULT_COMPRESSION, backup_mode='full', full_every=DEFAULT_FULL_EVERY, backup_state=None,
+                 layout='archive'):
         if basepath is None or basepath == '':
             raise ValueError('basepath can\'t be empty.')
         elif manager_type is None:
@@ -14,13 +26,22 @@ class FileGroup:
         self._name = name
         self._basepath = basepath
         self._files: list[File] = []
+        self._files_digest: Optional[str] = None # Memoized result of digest()
         self._md5 = self.digest() if digest is None else digest
+        self._compression = compression # See archive.parse_compression
+        self._backup_mode = backup_mode
+        self._full_every = full_every
+        # Digests of every file at the last backup and the last full one, for partial backups
+        self._backup_state: Optional[dict] = backup_state
+        self._layout = layout
         self._backup_manager = BackupManager(self, manager_type)
 
     def get_name(self): return self._name
     def get_basepath(self): return self._basepath
     def get_files(self) -> list[File]: return self._files
     def get_md5(self): return self._md5
+    def get_compression(self): return self._compression
+    def get_layout(self): return self._layout
 
     def log(self, msg):
         ansi_blue = '\033[1;94m'
@@ -37,6 +58,20 @@ class FileGroup:
 
     def set_property(self, name, value):
         """Modify property of a file group. Used exclusively from the command line."""
+        if name == 'compression':
+            archive.parse_compression(value)
+        elif name == 'backup_mode' and value not in self.BACKUP_MODES:
+            raise ValueError('Invalid backup mode "' + value + '". Valid modes: ' + ', '.join(self.BACKUP_MODES))
+        elif name == 'layout' and value not in self.LAYOUTS:
+            raise ValueError('Invalid layout "' + value + '". Valid layouts: ' + ', '.join(self.LAYOUTS))
+        elif name == 'layout' and value == 'tree' and not self._backup_manager.supports_trees():
+            raise ValueError('The tree layout is only supported by local backups.')
+        elif name == 'full_every':
+            if not value.isdigit() or int(value) < 1:
+                raise ValueError('full_every has to be a positive number.')
+
+            value = int(value)
+
         if name in self.__dict__:
             self.__dict__[name] = value
         elif f'_{name}' in self.__dict__: # Private member
@@ -45,13 +80,19 @@ class FileGroup:
             raise ValueError('Group ' + self._name + ' doesn\'t have property ' + name + '.')
 
     def digest(self):
-        """Process and return the MD5 hash of its files"""
-        md5_hash = hashlib.md5()
+        """
+            Return the MD5 hash of its files, combining the digests already stored in them.
+            It is memoized until a file is added, removed or has its digest updated
+        """
+        if self._files_digest is None:
+            md5_hash = hashlib.md5()
 
-        for file in self._files:
-            md5_hash.update(file.digest())
+            for file in self._files:
+                md5_hash.update(file.get_digest().encode('utf8'))
 
-        return md5_hash.hexdigest()
+            self._files_digest = md5_hash.hexdigest()
+
+        return self._files_digest
 
     def _get_filetype(self, filepath: str):
         if os.path.isdir(filepath):
@@ -82,37 +123,139 @@ class FileGroup:
             raise ValueError('File "' + file.get_filepath() + '" already exists.')
 
         self._files.append(file)
+        self._files_digest = None
 
     def remove_file_with_relpath(self, relpath):
         filepath = os.path.join(self._basepath, relpath)
 
         file = self._find_file_with_path(filepath)
         self._files.remove(file)
+        self._files_digest = None
+
+    def _scan_files(self, paranoid=False):
+        """Scan the existing files, returning the paths whose digest has to be calculated"""
+        self.log('...Scanning files')
 
-    def _update_digests(self):
-        self.log('...Updating digests')
+        return [ path for file in self._files if file.exists() for path in file.scan(paranoid) ]
 
+    def _apply_digests(self, digests: dict[str, bytes]):
+        """Update the digests from the last scan, given the digests of the paths it returned"""
         for file in self._files:
-            file.update_digest()
+            if file.exists():
+                file.update_digest_from_scan(digests)
 
+        self._files_digest = None
         self._md5 = self.digest()
 
-    def backup(self, rotation_number: int, force_if_unchanged: bool=False):
+    def _get_scanned_digests(self) -> dict[str, Optional[str]]:
+        """Get the digest of every file found by the last scan, keyed by path relative to the basepath"""
+        digests = {}
+
+        for file in self._files:
+            if file.exists():
+                digests.update(file.get_scanned_digests())
+
+        return digests
+
+    def _plan_backup(self, rotation_number: int) -> tuple[dict, Optional[set[str]]]:
+        """
+            Decide the type of the next backup.
+            Returns its manifest, and the paths it has to archive or None for all of them
+        """
+        # Every backup has an id, so the state can tell whether it describes the latest one
+        backup_id = os.urandom(16).hex()
+        state = self._backup_state
+
+        # Trees are always full, unchanged files are shared instead
+        if self._backup_mode == 'full' or self._layout == 'tree' or state is None:
+            return { 'type': 'full', 'id': backup_id }, None
+
+        # The state is saved with the config at the end of the run, so a backup may have been stored without it
+        latest = self._backup_manager.read_latest_manifest()
+
+        if latest is None or latest.get('id') != state.get('id'):
+            self.log('...The latest backup isn\'t the one the partial backups are based on. Making a full backup')
+            return { 'type': 'full', 'id': backup_id }, None
+
+        since_full = latest.get('since_full', 0) + 1
+
+        # A full backup is made periodically, and before the one it would be based on is rotated out
+        if since_full >= self._full_every or since_full > rotation_number:
+            return { 'type': 'full', 'id': backup_id }, None
+
+        base = state['last'] if self._backup_mode == 'incremental' else state['full']
+        current = self._get_scanned_digests()
+
+        # Pending files have no digest yet, so they are archived in case they have changed
+        changed = { relpath for relpath, md5 in current.items() if md5 is None or base.get(relpath) != md5 }
+        deleted = sorted(set(base) - set(current))
+
+        self.log(f'...{self._backup_mode.capitalize()} backup: {len(changed)} changed and {len(deleted)} deleted files')
+
+        return { 'type': self._backup_mode, 'id': backup_id, 'since_full': since_full, 'deleted': deleted }, changed
+
+    def _update_backup_state(self, manifest: dict):
+        if self._backup_mode == 'full' or self._layout == 'tree':
+            self._backup_state = None
+        else:
+            current = self._get_scanned_digests()
+
+            if manifest['type'] == 'full':
+                self._backup_state = { 'id': manifest['id'], 'since_full': 0, 'last': current, 'full': dict(current) }
+            else:
+                self._backup_state = { **self._backup_state, 'id': manifest['id'], 'since_full': manifest['since_full'], 'last': current }
+
+    def backup(self, rotation_number: int, force_if_unchanged: bool=False, paranoid: bool=False):
         if all([ not file.exists() for file in self._files ]):
             self.log('No files to backup. Skipping')
         else:
             previous_digest = self._md5
-            self._update_digests()
+            pending = self._scan_files(paranoid)
 
-            # If the files haven't changed and the force flag is off
-            if previous_digest == self._md5 and not force_if_unchanged:
+            # Every digest is cached, so the files don't have to be read to know they haven't changed
+            if not pending:
+                self._apply_digests({})
+
+            if not pending and previous_digest == self._md5 and not force_if_unchanged:
                 self.log(f'Digest hasn\'t changed ({self._md5}). Skipping')
             else:
-                self._backup_manager.backup(rotation_number)
+                manifest, selection = self._plan_backup(rotation_number)
+
+                # The pending files are hashed while they are archived, so each one is only read once
+                digests = self._backup_manager.create_backup(pending, manifest, selection)
 
-    def get_latest_backup(self, target_dir):
-        """Copy the latest backup to a directory"""
-        self._backup_manager.get_latest_backup(target_dir)
+                if digests is not None:
+                    self._apply_digests(digests)
+
+                    # If the files haven't changed and the force flag is off
+                    if previous_digest == self._md5 and not force_if_unchanged:
+                        self.log(f'Digest hasn\'t changed ({self._md5}). Discarding backup')
+                        self._backup_manager.discard_backup()
+                    else:
+                        self._backup_manager.commit_backup(rotation_number)
+                        self._update_backup_state(manifest)
+
+    def _to_relpaths(self, paths: list[str]) -> list[str]:
+        """Normalize paths given relative to the basepath, or as absolute ones under it"""
+        relpaths = []
+
+        for path in paths:
+            path = os.path.expanduser(path)
+            relpath = os.path.relpath(path, self._basepath) if os.path.isabs(path) else os.path.normpath(path)
+
+            if relpath == os.curdir or relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+                raise ValueError('Path "' + path + '" isn\'t under the basepath ' + self._basepath)
+
+            relpaths.append(relpath)
+
+        return relpaths
+
+    def get_latest_backup(self, target_dir, paths: Optional[list[str]] = None):
+        """Copy the latest backup to a directory, or extract only some paths of it"""
+        if paths:
+            self._backup_manager.get_latest_paths(target_dir, self._to_relpaths(paths))
+        else:
+            self._backup_manager.get_latest_backup(target_dir)
 
     def get_all_backups(self, target_dir):
         backups_dir = os.path.join(target_dir, 'backups')
@@ -124,16 +267,21 @@ class FileGroup:
         """Remove backups"""
         self._backup_manager.clean_backups()
 
-    def restore(self):
-        """Restore a backup to it's basepath"""
-        self._backup_manager.restore()
+    def restore(self, paths: Optional[list[str]] = None):
+        """Restore a backup to it's basepath, or only some paths of it"""
+        self._backup_manager.restore(self._to_relpaths(paths) if paths else None)
 
     def to_dict(self):
         return {
             'name': self._name,
             'basepath': self._basepath,
             'files': [ file.to_dict() for file in self._files ],
-            'md5': self._md5
+            'md5': self._md5,
+            'compression': self._compression,
+            'backup_mode': self._backup_mode,
+            'full_every': self._full_every,
+            'backup_state': self._backup_state,
+            'layout': self._layout
         }
 
     @classmethod
@@ -142,7 +290,12 @@ class FileGroup:
             group_dict['name'],
             group_dict['basepath'],
             group_dict['md5'],
-            manager_type
+            manager_type,
+            group_dict.get('compression', archive.DEFAULT_COMPRESSION),
+            group_dict.get('backup_mode', 'full'),
+            group_dict.get('full_every', cls.DEFAULT_FULL_EVERY),
+            group_dict.get('backup_state'),
+            group_dict.get('layout', 'archive')
         )
 
         for file in group_dict['files']:
@@ -150,7 +303,8 @@ class FileGroup:
                 os.path.join(group_dict['basepath'], file['relpath']),
                 group_dict['basepath'],
                 Filetype(file['filetype']),
-                file['md5']
+                file['md5'],
+                file.get('cache')
             ))
 
         return group
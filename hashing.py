@@ -0,0 +1,90 @@
+import os
+import hashlib
+import threading
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024 # Bytes read per call when hashing a file
+DEFAULT_JOBS = os.cpu_count() or 1 # Files hashed at the same time
+
+_block_size = DEFAULT_BLOCK_SIZE
+_jobs = DEFAULT_JOBS
+_local = threading.local() # Holds one preallocated read buffer per thread
+
+def set_block_size(block_size: int):
+    """Change the size of the buffer used to read files"""
+    global _block_size
+
+    if block_size <= 0:
+        raise ValueError('Invalid block size: ' + str(block_size))
+
+    _block_size = block_size
+
+def get_block_size():
+    return _block_size
+
+def set_jobs(jobs: int):
+    """Change the number of threads used to hash files"""
+    global _jobs
+
+    if jobs <= 0:
+        raise ValueError('Invalid number of jobs: ' + str(jobs))
+
+    _jobs = jobs
+
+def get_jobs():
+    return _jobs
+
+def _get_buffer(block_size: int) -> memoryview:
+    """Get the read buffer of the current thread, allocating it if needed"""
+    buffer = getattr(_local, 'buffer', None)
+
+    if buffer is None or len(buffer) != block_size:
+        buffer = memoryview(bytearray(block_size))
+        _local.buffer = buffer
+
+    return buffer
+
+def read_blocks(filepath, block_size=None):
+    """
+        Yield the contents of a file in blocks of at most block_size bytes.
+        The blocks are views of a buffer reused between iterations, so they
+        have to be consumed before asking for the next one
+    """
+    buffer = _get_buffer(block_size or _block_size)
+
+    with open(filepath, 'rb', buffering=0) as file:
+        while True:
+            n = file.readinto(buffer)
+
+            if not n:
+                break
+
+            yield buffer[:n]
+
+def new_file_hash(filepath):
+    """Create the hash object of a file, seeded with its name"""
+    # Add the file name to enforce hash changes on file name change
+    return hashlib.md5(os.path.basename(filepath).encode('utf-8'))
+
+def file_digest(filepath, block_size=None) -> bytes:
+    """Calculate the MD5 digest of a file without loading it whole into memory"""
+    _hash = new_file_hash(filepath)
+
+    for block in read_blocks(filepath, block_size):
+        _hash.update(block)
+
+    return _hash.hexdigest().encode('utf8')
+
+def digest_files(filepaths: list[str]) -> dict[str, bytes]:
+    """
+        Calculate the digest of several files, spread over a thread pool.
+        hashlib releases the GIL while hashing each block, so the files are
+        hashed in parallel. Returns a dictionary of filepath -> digest
+    """
+    if _jobs == 1 or len(filepaths) <= 1:
+        return { filepath: file_digest(filepath) for filepath in filepaths }
+
+    # Imported here, it's slow to import and most commands don't hash anything
+    from concurrent.futures import ThreadPoolExecutor # pylint: disable=import-outside-toplevel
+
+    with ThreadPoolExecutor(max_workers=min(_jobs, len(filepaths))) as executor:
+        return dict(zip(filepaths, executor.map(file_digest, filepaths)))
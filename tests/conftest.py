@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from file import File
+from backup_managers.manager_local import ManagerLocal
+from backup_managers.manager_cas import ManagerCAS
+
+@pytest.fixture
+def backup_env(tmp_path, monkeypatch):
+    """Keep the backups and the files replaced by restores in tmp_path"""
+    monkeypatch.setattr(ManagerLocal, 'BACKUP_FOLDER', str(tmp_path / 'backups'))
+    monkeypatch.setattr(ManagerCAS, 'BACKUP_FOLDER', str(tmp_path / 'cas'))
+    # Files are written right before backing them up
+    monkeypatch.setattr(File, 'RACY_WINDOW_NS', 0)
+    # Restores move the files they replace to the temporary directory
+    (tmp_path / 'tmp').mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+
+def read_tree(root):
+    """Contents of the files under a directory, by path relative to it"""
+    return { os.path.relpath(os.path.join(dirpath, name), root): open(os.path.join(dirpath, name), 'rb').read()
+             for dirpath, _, names in os.walk(root) for name in names }
@@ -0,0 +1,130 @@
+import io
+import os
+import json
+import zipfile
+import pytest
+import archive
+from archive import ParallelZipWriter
+
+class _UnseekableFile:
+    """File that can only be written to, like a network stream"""
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.buffer.tell()
+
+    def flush(self):
+        ...
+
+def _make_files(root):
+    os.makedirs(os.path.join(root, 'd', 'sub'))
+    contents = {
+        'd/small.txt': b'hello\n' * 10,
+        'd/empty': b'',
+        'd/sub/random.bin': os.urandom(300_000),
+        'd/sub/text.txt': b''.join(b'line %d\n' % i for i in range(200_000))
+    }
+
+    for relpath, data in contents.items():
+        with open(os.path.join(root, relpath), 'wb') as file:
+            file.write(data)
+
+    return contents
+
+def _write_zip(file, root, contents, compression, jobs):
+    # Small chunks, so large members are split between several jobs
+    writer = ParallelZipWriter(file, compression, jobs=jobs)
+    writer.CHUNK_SIZE = 64 * 1024
+    read = {}
+
+    with writer:
+        writer.write_data(archive.MANIFEST_NAME, b'{"type": "full"}')
+        writer.write_dir(os.path.join(root, 'd'), 'd')
+
+        for relpath in contents:
+            blocks = []
+            writer.write_file(os.path.join(root, relpath), relpath, on_block=lambda block, blocks=blocks: blocks.append(bytes(block)),
+                              compress=not relpath.endswith('.bin'))
+            read[relpath] = b''.join(blocks)
+
+    return read
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_LZMA])
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_parallel_zip_round_trip(tmp_path, compression, jobs):
+    contents = _make_files(str(tmp_path / 'src'))
+    zip_path = str(tmp_path / 'backup.zip')
+
+    read = _write_zip(zip_path, str(tmp_path / 'src'), contents, compression, jobs)
+
+    assert read == contents
+
+    with zipfile.ZipFile(zip_path) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.read(archive.MANIFEST_NAME) == b'{"type": "full"}'
+        assert zipf.getinfo('d/').is_dir()
+
+        for relpath, data in contents.items():
+            assert zipf.read(relpath) == data
+
+        assert zipf.getinfo('d/sub/random.bin').compress_type == zipfile.ZIP_STORED
+
+def test_parallel_zip_output_doesnt_depend_on_jobs(tmp_path):
+    contents = _make_files(str(tmp_path / 'src'))
+    outputs = []
+
+    for jobs in (1, 3):
+        file = io.BytesIO()
+        _write_zip(file, str(tmp_path / 'src'), contents, zipfile.ZIP_DEFLATED, jobs)
+        outputs.append(file.getvalue())
+
+    assert outputs[0] == outputs[1]
+
+def test_parallel_zip_unseekable_output(tmp_path):
+    contents = _make_files(str(tmp_path / 'src'))
+    file = _UnseekableFile()
+
+    _write_zip(file, str(tmp_path / 'src'), contents, zipfile.ZIP_DEFLATED, 2)
+
+    with zipfile.ZipFile(io.BytesIO(file.buffer.getvalue())) as zipf:
+        assert zipf.testzip() is None
+
+        for relpath, data in contents.items():
+            assert zipf.read(relpath) == data
+
+@pytest.mark.parametrize('compression', ['store', 'deflate', 'zstd'])
+def test_extract_members_selects_paths(tmp_path, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+
+    contents = _make_files(str(tmp_path / 'src'))
+    archive_name = archive.get_archive_name(compression)
+    archive_path = str(tmp_path / archive_name)
+    digests = { relpath: str(i) for i, relpath in enumerate(contents) }
+
+    with archive.open_archive_writer(archive_path, compression) as writer:
+        writer.write_data(archive.MANIFEST_NAME, b'{"type": "full"}')
+        writer.write_dir(str(tmp_path / 'src' / 'd'), 'd')
+        writer.write_dir(str(tmp_path / 'src' / 'd' / 'sub'), 'd/sub')
+
+        for relpath in contents:
+            writer.write_file(str(tmp_path / 'src' / relpath), relpath)
+
+        writer.write_data(archive.DIGESTS_NAME, json.dumps(digests).encode('utf8'))
+
+    target = tmp_path / 'target'
+
+    with open(archive_path, 'rb') as file:
+        # d/su is a prefix of d/sub, but not a path above it
+        manifest, extracted = archive.extract_members(file, archive_name, str(target), ['d/sub', 'd/small.txt', 'd/su'], {'d/sub/text.txt'})
+
+    assert manifest == { 'type': 'full', 'digests': digests }
+    assert extracted == {'d/sub/random.bin', 'd/small.txt'}
+    assert { os.path.relpath(os.path.join(root, name), target) for root, _, names in os.walk(target) for name in names } == extracted
+
+    for relpath in extracted:
+        assert (target / relpath).read_bytes() == contents[relpath]
@@ -0,0 +1,249 @@
+import os
+import copy
+import zipfile
+from unittest.mock import ANY
+import pytest
+import archive
+import hashing
+from filegroup import FileGroup
+from backup_manager import ManagerType
+from backup_managers.snapshot_index import INDEX_NAME
+from conftest import read_tree
+
+@pytest.fixture
+def make_group(tmp_path, backup_env):
+    def make_group(backup_mode, compression='deflate', layout='archive'):
+        basepath = tmp_path / 'src'
+        (basepath / 'd' / 'sub').mkdir(parents=True)
+
+        for i in range(4):
+            (basepath / 'd' / f'f{i}').write_text(f'file {i}\n' * 100)
+
+        (basepath / 'top.txt').write_text('top')
+
+        group = FileGroup('grp', str(basepath), None, ManagerType.LOCAL, compression)
+        group.add_file_with_path(str(basepath / 'd'))
+        group.add_file_with_path(str(basepath / 'top.txt'))
+        group.set_property('backup_mode', backup_mode)
+        group.set_property('full_every', '5')
+        group.set_property('layout', layout)
+        group.backup(4, force_if_unchanged=True)
+
+        return group
+
+    return make_group
+
+def _make_changes(group, src):
+    """Back up a series of changes, returning the files as they were in the last backup"""
+    (src / 'd' / 'f1').write_text('changed 1')
+    group.backup(4)
+    os.remove(src / 'd' / 'f2')
+    (src / 'd' / 'sub' / 'new').write_text('new')
+    group.backup(4)
+    (src / 'd' / 'f3').write_text('changed 3')
+    (src / 'd' / 'f1').write_text('changed 1 again')
+    group.backup(4)
+
+    return read_tree(str(src))
+
+@pytest.mark.parametrize('backup_mode', ['full', 'incremental', 'differential'])
+@pytest.mark.parametrize('compression', ['deflate', 'zstd'])
+def test_restore_chain(make_group, tmp_path, backup_mode, compression):
+    group = make_group(backup_mode, compression)
+    src = tmp_path / 'src'
+    expected = _make_changes(group, src)
+
+    (src / 'd' / 'f3').write_text('broken')
+    (src / 'd' / 'f2').write_text('deleted before the last backup')
+    group.restore()
+
+    # Directories are replaced whole, so files deleted before the last backup aren't brought back
+    assert read_tree(str(src)) == expected
+
+@pytest.mark.parametrize('backup_mode', ['incremental', 'differential'])
+def test_get_rebuilds_chain(make_group, tmp_path, backup_mode):
+    group = make_group(backup_mode)
+    expected = _make_changes(group, tmp_path / 'src')
+    target = tmp_path / 'get'
+    target.mkdir()
+
+    group.get_latest_backup(str(target))
+
+    extracted = tmp_path / 'extracted'
+    archive.extract_archive(str(target / archive.ZIP_ARCHIVE), str(extracted))
+    assert read_tree(str(extracted)) == expected
+
+def test_get_rebuilds_chain_with_new_compression(make_group, tmp_path):
+    group = make_group('incremental', 'deflate')
+    expected = _make_changes(group, tmp_path / 'src')
+    target = tmp_path / 'get'
+    target.mkdir()
+
+    group.set_property('compression', 'zstd')
+    group.get_latest_backup(str(target))
+
+    assert os.listdir(target) == [archive.TAR_ZSTD_ARCHIVE]
+
+    extracted = tmp_path / 'extracted'
+    archive.extract_archive(str(target / archive.TAR_ZSTD_ARCHIVE), str(extracted))
+    assert read_tree(str(extracted)) == expected
+
+@pytest.mark.parametrize('backup_mode', ['incremental', 'differential'])
+def test_restore_paths_chain(make_group, tmp_path, backup_mode):
+    group = make_group(backup_mode)
+    src = tmp_path / 'src'
+    expected = _make_changes(group, src)
+
+    (src / 'd' / 'f1').write_text('broken')
+    (src / 'd' / 'f0').write_text('broken')
+    (src / 'top.txt').write_text('not restored')
+    group.restore(['d/f1', str(src / 'd' / 'f0')])
+
+    assert read_tree(str(src)) == { **expected, 'top.txt': b'not restored' }
+
+    target = tmp_path / 'get'
+    group.get_latest_backup(str(target), ['d'])
+    assert read_tree(str(target)) == { relpath: data for relpath, data in expected.items() if relpath.startswith('d/') }
+
+def test_restore_tree(make_group, tmp_path):
+    group = make_group('full', layout='tree')
+    src = tmp_path / 'src'
+    expected = _make_changes(group, src)
+
+    (src / 'd' / 'f3').write_text('broken')
+    group.restore()
+
+    assert read_tree(str(src)) == expected
+    # The restored files are copies, not the read only files of the tree
+    (src / 'd' / 'f3').write_text('writable')
+
+def test_get_tree_twice(make_group, tmp_path):
+    group = make_group('full', layout='tree')
+    src = tmp_path / 'src'
+    target = tmp_path / 'get'
+    target.mkdir()
+    group.get_latest_backup(str(target))
+    first = read_tree(str(src))
+
+    (src / 'd' / 'f1').write_text('changed 1')
+    os.remove(src / 'd' / 'f2')
+    group.backup(4)
+    group.get_latest_backup(str(target))
+    # The copy is replaced whole, without writing through it to the backups
+    assert read_tree(str(target / 'backup.tree')) == { **read_tree(str(src)), archive.MANIFEST_NAME: ANY }
+    (target / 'backup.tree' / 'd' / 'f3').write_text('writable')
+
+    all_backups = tmp_path / 'all'
+    all_backups.mkdir()
+    group.get_all_backups(str(all_backups))
+    assert read_tree(str(all_backups / 'backups' / 'grp' / 'backup.tree.1')) == { **first, archive.MANIFEST_NAME: ANY }
+
+def test_tree_layout_is_local(backup_env, tmp_path):
+    group = FileGroup('grp', str(tmp_path), None, ManagerType.CAS, 'zstd')
+
+    with pytest.raises(ValueError):
+        group.set_property('layout', 'tree')
+
+def test_restore_tree_checks_digests(make_group, tmp_path):
+    group = make_group('full', layout='tree')
+    src = tmp_path / 'src'
+    expected = _make_changes(group, src)
+
+    # Tree names end with the time they were made
+    latest_tree = max(name for name in os.listdir(tmp_path / 'backups' / 'grp') if name.startswith('backup.tree'))
+    tree_file = tmp_path / 'backups' / 'grp' / latest_tree / 'd' / 'f3'
+    os.chmod(tree_file, 0o644)
+    tree_file.write_text('corrupted')
+
+    with pytest.raises(ValueError):
+        group.restore()
+
+    assert read_tree(str(src)) == expected
+
+def _rewrite_latest_zip(tmp_path, change):
+    """Rewrite the members of the latest backup, a zip, through change(name, data) -> data or None to drop it"""
+    folder = tmp_path / 'backups' / 'grp'
+    latest = folder / max(name for name in os.listdir(folder) if name.startswith(archive.ZIP_ARCHIVE))
+
+    with zipfile.ZipFile(latest) as zipf:
+        members = [ (info, zipf.read(info)) for info in zipf.infolist() ]
+
+    with zipfile.ZipFile(latest, 'w') as zipf:
+        for info, data in members:
+            data = change(info.filename, data)
+
+            if data is not None:
+                zipf.writestr(info, data)
+
+@pytest.mark.parametrize('change', [
+    lambda name, data: b'tampered' if name == 'd/f1' else data,
+    lambda name, data: None if name == archive.DIGESTS_NAME else data
+], ids=['mismatch', 'missing'])
+def test_restore_paths_checks_recorded_digests(make_group, tmp_path, change):
+    group = make_group('incremental')
+    src = tmp_path / 'src'
+    expected = _make_changes(group, src)
+    _rewrite_latest_zip(tmp_path, change)
+
+    (src / 'd' / 'f1').write_text('broken')
+
+    with pytest.raises(ValueError):
+        group.restore(['d/f1'])
+
+    assert (src / 'd' / 'f1').read_text() == 'broken'
+    assert read_tree(str(src)) == { **expected, 'd/f1': b'broken' }
+
+@pytest.mark.parametrize('backup_mode', ['incremental', 'differential'])
+def test_backup_stored_without_saving_state(make_group, tmp_path, backup_mode):
+    group = make_group(backup_mode)
+    src = tmp_path / 'src'
+    (src / 'd' / 'f1').write_text('changed 1')
+    group.backup(4)
+
+    # The run that stores the next backup stops before the config with its state is saved
+    state = copy.deepcopy(group._backup_state)
+    (src / 'd' / 'f1').write_text('changed 1 again')
+    group.backup(4)
+    group._backup_state = state
+
+    os.remove(src / 'd' / 'f2')
+    group.backup(4)
+    expected = read_tree(str(src))
+
+    target = tmp_path / 'get'
+    target.mkdir()
+    group.get_latest_backup(str(target))
+    extracted = tmp_path / 'extracted'
+    archive.extract_archive(str(target / archive.ZIP_ARCHIVE), str(extracted))
+    assert read_tree(str(extracted)) == expected
+
+    (src / 'd' / 'f1').write_text('broken')
+    group.restore()
+    assert read_tree(str(src)) == expected
+
+def test_legacy_backups(make_group, tmp_path, monkeypatch):
+    group = make_group('full')
+    src = tmp_path / 'src'
+    (src / 'd' / 'f1').write_text('changed 1')
+    group.backup(4)
+    expected = read_tree(str(src))
+
+    # Backups made before the index were rotated by renaming them
+    manager = group._backup_manager._manager
+    folder = manager.get_group_folder()
+    for index, entry in enumerate(manager._get_index().get_entries()):
+        os.rename(os.path.join(folder, entry['name']), os.path.join(folder, archive.get_backup_name(entry['archive'], index)))
+    os.remove(os.path.join(folder, INDEX_NAME))
+    manager._index = None
+
+    # Their index is rebuilt without reading them
+    with monkeypatch.context() as patch:
+        patch.setattr(hashing, 'read_blocks', None)
+        entries = manager._get_index().get_entries()
+
+    assert [ entry['name'] for entry in entries ] == [ archive.ZIP_ARCHIVE, archive.ZIP_ARCHIVE + '.1' ]
+    assert [ entry['digest'] for entry in entries ] == [ None, None ]
+
+    (src / 'd' / 'f1').write_text('broken')
+    group.restore()
+    assert read_tree(str(src)) == expected
@@ -0,0 +1,90 @@
+import os
+import errno
+import shutil
+import pytest
+import copying
+
+@pytest.fixture(autouse=True)
+def reset_unsupported(monkeypatch):
+    # Methods that fail are remembered for the whole process
+    monkeypatch.setattr(copying, '_unsupported', set())
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    os.chmod(path, 0o640)
+    os.utime(path, ns=(1_000_000_000, 2_000_000_000))
+
+    return path
+
+def _assert_copied(source, target):
+    assert target.read_bytes() == source.read_bytes()
+    assert os.stat(target).st_mode == os.stat(source).st_mode
+    assert os.stat(target).st_mtime_ns == os.stat(source).st_mtime_ns
+
+@pytest.mark.parametrize('method', copying.METHODS)
+def test_copy_with_each_method(source, tmp_path, monkeypatch, method):
+    if not copying._is_available(method):
+        pytest.skip(f'{method} is not available')
+
+    # The buffer is the last resort of every method
+    monkeypatch.setattr(copying, 'METHODS', [method, copying.BUFFER])
+    target = tmp_path / 'target'
+
+    used = copying.copy_file(str(source), str(target))
+
+    assert used in (method, copying.BUFFER)
+    _assert_copied(source, target)
+
+def test_falls_back_after_partial_copy(source, tmp_path, monkeypatch):
+    def fail_halfway(source_fd, target_fd, size):
+        os.write(target_fd, os.read(source_fd, size // 2))
+        raise OSError(errno.EOPNOTSUPP, 'Not supported')
+
+    monkeypatch.setattr(copying, 'METHODS', [copying.REFLINK, copying.BUFFER])
+    monkeypatch.setattr(copying, '_is_available', lambda method: True)
+    monkeypatch.setitem(copying._FUNCTIONS, copying.REFLINK, fail_halfway)
+    target = tmp_path / 'target'
+
+    assert copying.copy_file(str(source), str(target)) == copying.BUFFER
+    _assert_copied(source, target)
+    # It isn't tried again between the same devices
+    assert copying.copy_file(str(source), str(tmp_path / 'other')) == copying.BUFFER
+
+@pytest.mark.parametrize('method, function', [(copying.COPY_FILE_RANGE, 'copy_file_range'), (copying.SENDFILE, 'sendfile')])
+def test_falls_back_when_kernel_copies_nothing(source, tmp_path, monkeypatch, method, function):
+    monkeypatch.setattr(copying, 'METHODS', [method, copying.BUFFER])
+    monkeypatch.setattr(os, function, lambda *args: 0, raising=False)
+    target = tmp_path / 'target'
+
+    assert copying.copy_file(str(source), str(target)) == copying.BUFFER
+    _assert_copied(source, target)
+
+def test_short_copy_raises(source, tmp_path, monkeypatch):
+    monkeypatch.setattr(copying, 'METHODS', [copying.BUFFER])
+    monkeypatch.setitem(copying._FUNCTIONS, copying.BUFFER, lambda source_fd, target_fd, size: os.write(target_fd, b'short'))
+
+    with pytest.raises(ValueError):
+        copying.copy_file(str(source), str(tmp_path / 'target'))
+
+def test_same_file(source, tmp_path):
+    data = source.read_bytes()
+    os.link(source, tmp_path / 'link')
+
+    for target in (source, tmp_path / 'link'):
+        with pytest.raises(shutil.SameFileError):
+            copying.copy_file(str(source), str(target))
+
+    assert source.read_bytes() == data
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='Named pipes are not available')
+def test_special_files(source, tmp_path):
+    fifo = tmp_path / 'fifo'
+    os.mkfifo(fifo)
+
+    with pytest.raises(shutil.SpecialFileError):
+        copying.copy_file(str(fifo), str(tmp_path / 'target'))
+
+    with pytest.raises(shutil.SpecialFileError):
+        copying.copy_file(str(source), str(fifo))
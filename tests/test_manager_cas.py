@@ -0,0 +1,104 @@
+import os
+import zipfile
+import pytest
+import archive
+from filegroup import FileGroup
+from backup_manager import ManagerType
+from backup_managers.manager_cas import ManagerCAS
+from conftest import read_tree
+
+@pytest.fixture
+def group(tmp_path, backup_env):
+    basepath = tmp_path / 'src'
+    (basepath / 'd' / 'sub').mkdir(parents=True)
+    (basepath / 'd' / 'big.bin').write_bytes(os.urandom(3 * 1024 * 1024))
+    (basepath / 'd' / 'sub' / 'text.txt').write_text('text\n' * 1000)
+    (basepath / 'top.txt').write_text('top')
+
+    group = FileGroup('grp', str(basepath), None, ManagerType.CAS, 'zstd')
+    group.add_file_with_path(str(basepath / 'd'))
+    group.add_file_with_path(str(basepath / 'top.txt'))
+    # Adding the files already records their digest
+    group.backup(2, force_if_unchanged=True)
+
+    return group
+
+def _stored_bytes(folder):
+    objects = os.path.join(folder, 'objects')
+    return sum( os.path.getsize(os.path.join(objects, prefix, name)) for prefix in os.listdir(objects) for name in os.listdir(os.path.join(objects, prefix)) )
+
+def test_cas_round_trip(group, tmp_path):
+    basepath = group.get_basepath()
+    expected = read_tree(basepath)
+
+    (tmp_path / 'src' / 'top.txt').write_text('broken')
+    os.remove(tmp_path / 'src' / 'd' / 'big.bin')
+    group.restore()
+
+    assert read_tree(basepath) == expected
+
+    target = tmp_path / 'get'
+    target.mkdir()
+    group.get_latest_backup(str(target))
+
+    with zipfile.ZipFile(target / archive.ZIP_ARCHIVE) as zipf:
+        manifest = archive.read_manifest(str(target / archive.ZIP_ARCHIVE))
+        assert manifest['type'] == 'full' and set(manifest['digests']) == set(expected)
+        assert { name: zipf.read(name) for name in zipf.namelist() if not name.endswith('/') and name != archive.MANIFEST_NAME } == expected
+
+def test_cas_only_stores_changed_data(group, tmp_path):
+    folder = ManagerCAS.BACKUP_FOLDER
+    stored = _stored_bytes(folder)
+
+    # A byte inserted at the start of the large file only changes its first chunk
+    big = tmp_path / 'src' / 'd' / 'big.bin'
+    big.write_bytes(b'x' + big.read_bytes())
+    group.backup(2)
+
+    assert _stored_bytes(folder) - stored < ManagerCAS.MAX_CHUNK_SIZE
+    assert stored > 3 * 1024 * 1024
+
+def test_cas_unchanged_contents_store_nothing(group, tmp_path):
+    folder = ManagerCAS.BACKUP_FOLDER
+    stored = _stored_bytes(folder)
+
+    # The stats change but the contents don't
+    os.utime(tmp_path / 'src' / 'top.txt', (1, 1))
+    group.backup(2)
+
+    assert _stored_bytes(folder) == stored
+    assert len(os.listdir(os.path.join(folder, 'snapshots', 'grp'))) == 1
+
+def test_cas_rotation_collects_garbage(group, tmp_path):
+    folder = ManagerCAS.BACKUP_FOLDER
+
+    for i in range(4):
+        (tmp_path / 'src' / 'd' / 'big.bin').write_bytes(os.urandom(1024 * 1024))
+        group.backup(1)
+
+    # The latest backup and one more are kept
+    assert len(os.listdir(os.path.join(folder, 'snapshots', 'grp'))) == 2
+    assert _stored_bytes(folder) < 3 * 1024 * 1024
+
+def test_cas_extracts_only_selected_paths(group, tmp_path):
+    target = tmp_path / 'get'
+    target.mkdir()
+
+    group.get_latest_backup(str(target), ['d/sub'])
+
+    assert read_tree(str(target)) == { 'd/sub/text.txt': b'text\n' * 1000 }
+
+def test_cut_chunks_follow_content():
+    manager = ManagerCAS('grp')
+    data = os.urandom(4 * 1024 * 1024)
+
+    def cut(data):
+        return list(manager.cut_chunks(bytearray(data), eof=True))
+
+    chunks = cut(data)
+    shifted = cut(b'inserted' + data)
+
+    assert b''.join(chunks) == data
+    assert all( len(chunk) <= ManagerCAS.MAX_CHUNK_SIZE for chunk in chunks )
+    # Only the chunk with the insertion changes
+    assert chunks[1:] == shifted[1:]
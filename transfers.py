@@ -0,0 +1,79 @@
+import time
+import threading
+
+DEFAULT_MAX_IN_FLIGHT = 4 # Transfers running at the same time
+
+_max_in_flight = DEFAULT_MAX_IN_FLIGHT
+_executor = None
+_pending: list[tuple[str, 'Future']] = []
+_lock = threading.Lock()
+_done = 0
+
+def set_max_in_flight(max_in_flight: int):
+    """Change the number of transfers running at the same time"""
+    global _max_in_flight
+
+    if max_in_flight <= 0:
+        raise ValueError('Invalid number of transfers: ' + str(max_in_flight))
+    elif _executor is not None:
+        raise ValueError('The number of transfers can\'t be changed once they have started.')
+
+    _max_in_flight = max_in_flight
+
+def get_max_in_flight():
+    return _max_in_flight
+
+def _log(msg):
+    with _lock:
+        print(f'[TRANSFER] ({_done}/{len(_pending)}) {msg}')
+
+def _run(name, function, args):
+    global _done
+
+    _log(f'...Started {name}')
+    start = time.monotonic()
+
+    try:
+        return function(*args)
+    finally:
+        with _lock:
+            _done += 1
+
+        _log(f'...Finished {name} in {time.monotonic() - start:.1f}s')
+
+def submit(name, function, *args) -> 'Future':
+    """
+        Run a transfer in the background. There are at most max_in_flight of them
+        running at the same time, the rest wait in a queue. See wait
+    """
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            # Imported here, it's slow to import and most commands don't transfer anything
+            from concurrent.futures import ThreadPoolExecutor # pylint: disable=import-outside-toplevel
+            _executor = ThreadPoolExecutor(max_workers=_max_in_flight, thread_name_prefix='transfer')
+
+        future = _executor.submit(_run, name, function, args)
+        _pending.append((name, future))
+
+    return future
+
+def wait():
+    """Wait for every submitted transfer. If any of them failed, its error is raised once all have finished"""
+    global _done
+
+    with _lock:
+        pending = list(_pending)
+
+    errors = [ (name, future.exception()) for name, future in pending if future.exception() is not None ]
+
+    with _lock:
+        del _pending[:len(pending)]
+        _done = 0
+
+    for name, error in errors:
+        print(f'[TRANSFER] {name} failed: {error}')
+
+    if errors:
+        raise errors[0][1]
@@ -1,3 +1,5 @@
+from archive import ARCHIVE_NAMES
+
 def print_directory_tree(d, prefix=''):
     """
         Recursively prints a tree-like structure of a dictionary
@@ -20,7 +22,7 @@ def print_directory_tree(d, prefix=''):
         # Color it differently depending if it's a directory, a recent backup or other file
         if isinstance(value['files'], dict) and len(value['files']) > 0:
             color = ansi_blue
-        elif key == 'backup.zip':
+        elif key in ARCHIVE_NAMES:
             color = ansi_red
         else:
             color = ''